@@ -1,83 +1,119 @@
-from datetime import datetime, timedelta
+import csv
+import hashlib
+import io
 
-from flask import Blueprint, request, current_app, jsonify, url_for
-from flask_security import auth_required
-from playhouse.shortcuts import model_to_dict
+from datetime import date, datetime, timedelta
+from functools import wraps
+
+from flask import Blueprint, abort, request, current_app, json, jsonify, stream_with_context, url_for
+from flask_security import auth_required, current_user
 from playhouse.flask_utils import get_object_or_404
 from pytz import timezone, utc
+from werkzeug.http import is_resource_modified
+
+import metrics
+import settings
+import trends
 
-from models import Sleep, User, Day, Stress
+from charts import SLEEP_PHASES_CONFIG, phase_intervals
+from instrumentation import timed
+from models import (
+    INSIGHT_OUTCOMES, Credential, Daily, Job, Moments, Rollup, Sleep, User, Day, Stress, db_wrapper, split_phases,
+)
+from utils import LRUCache
 
 
 bp = Blueprint("api", __name__, url_prefix="/api")
+# days per query when streaming exports
+EXPORT_CHUNK_SIZE = 200
+# (user, data version, endpoint, args) -> JSON body, cf `cached_response`
+response_cache = LRUCache(maxsize=1024, maxbytes=settings.API_CACHE_MAX_BYTES)
 
 
-@bp.route("/sleep/garmin", methods=["POST"])
-def api_sleep_garmin():
-    data = request.json
-    if not data or not data.get("sleeps"):
-        current_app.logger.error(f"Malformed data: {request.text}")
-        return "No sleeps json found", 400
+def json_response(data):
+    with timed("json"):
+        return jsonify(data)
 
-    for sleep in data["sleeps"]:
-        try:
-            user = User.get(
-                User.token["garmin"]["oauth_token"] == sleep["userAccessToken"]
-            )
-        except (User.DoesNotExist, KeyError):
+
+def garmin_users(summaries):
+    """Resolve the users of a Garmin push payload in a single query"""
+    tokens = {s["userAccessToken"] for s in summaries if s.get("userAccessToken")}
+    user_ids = Credential.user_ids("garmin", tokens)
+    if not user_ids:
+        return {}
+    users = {u.id: u for u in User.select().where(User.id.in_(list(user_ids.values())))}
+    return {token: users[user_id] for (token, user_id) in user_ids.items() if user_id in users}
+
+
+def attach_days(rows):
+    """Replace `(user, calendarDate)` in `rows` by their upserted Day ids"""
+    days = Day.bulk_get_or_create((user.id, day) for (user, day, _) in rows)
+    return [{"day": days[(user.id, day)].id, **kwargs} for (user, day, kwargs) in rows]
+
+
+def garmin_sleep_kwargs(sleep):
+    """Sleep fields from a Garmin sleep summary, REM and levels are missing from the non-daily ones"""
+    start = datetime.fromtimestamp(sleep["startTimeInSeconds"])
+    end = start + timedelta(seconds=sleep["durationInSeconds"])
+    return {
+        "duration_total":  sleep["durationInSeconds"],
+        "duration_rem":  sleep.get("remSleepInSeconds", 0),
+        "duration_deep":  sleep["deepSleepDurationInSeconds"],
+        "duration_awake":  sleep["awakeDurationInSeconds"],
+        "phases":  sleep.get("sleepLevelsMap"),
+        "start":  start,
+        "end":  end,
+        "offset": sleep["startTimeOffsetInSeconds"],
+    }
+
+
+def ingest_garmin_sleeps(sleeps):
+    """Upsert Garmin sleep summaries in a single transaction"""
+    users = garmin_users(sleeps)
+    rows, fragments = [], []
+    for sleep in sleeps:
+        user = users.get(sleep.get("userAccessToken"))
+        if not user:
             current_app.logger.error(f"No user found for sleep {sleep}")
-            continue
-        # FIXME: use those w/o calendarDate too? apparently they're not daily and have different values
-        # maybe triggered by enabling stress endpoint (since they are stress values in there)
-        # cf `data/non-daily-sleep-payload.json`
-        if not sleep.get("calendarDate"):
-            current_app.logger.info("Ignoring sleep payload w/o calendarDate: {sleep}")
+            metrics.webhook("garmin", "sleep", "skipped")
             continue
         try:
-            day = Day.get_or_create(sleep["calendarDate"], user, autosave=True)
-            start = datetime.fromtimestamp(sleep["startTimeInSeconds"])
-            end = start + timedelta(seconds=sleep["durationInSeconds"])
-            kwargs = {
-                "duration_total":  sleep["durationInSeconds"],
-                "duration_rem":  sleep["remSleepInSeconds"],
-                "duration_deep":  sleep["deepSleepDurationInSeconds"],
-                "duration_awake":  sleep["awakeDurationInSeconds"],
-                "phases":  sleep["sleepLevelsMap"],
-                "start":  start,
-                "end":  end,
-                "offset": sleep["startTimeOffsetInSeconds"],
-            }
+            kwargs = garmin_sleep_kwargs(sleep)
         except KeyError as e:
             current_app.logger.error(f"Missing data: {e} — {sleep}")
-            return "Missing data", 400
+            metrics.webhook("garmin", "sleep", "skipped")
+            continue
+        # summaries w/o calendarDate are not daily, cf `data/garmin-non-daily-sleep-payload.json`
+        if sleep.get("calendarDate"):
+            rows.append((user, date.fromisoformat(sleep["calendarDate"]), kwargs))
         else:
-            sleep_obj = Sleep.create_or_update(day, "garmin", kwargs)
-            current_app.logger.debug(f"Updated sleep {sleep_obj.id}")
+            fragments.append((user, kwargs))
 
-    return "thanks :-)", 200
+    with Moments.lock({user.id for (user, _, _) in rows} | {user.id for (user, _) in fragments}):
+        Sleep.bulk_create_or_update("garmin", attach_days(rows))
+        # after the daily ones, they may be the nights of the fragments
+        merged = Sleep.merge_fragments("garmin", fragments) if fragments else 0
+    metrics.webhook("garmin", "sleep", "processed", len(rows) + merged)
+    metrics.webhook("garmin", "sleep", "skipped", len(fragments) - merged)
+    current_app.logger.debug(f"Updated {len(rows)} sleeps, merged {merged} of {len(fragments)} fragments")
 
 
-@bp.route("/stress/garmin", methods=["POST"])
-def api_stress_garmin():
-    data = request.json
-    if not data or not data.get("stressDetails"):
-        current_app.logger.error(f"Malformed data: {request.json}")
-        return "No stress json found", 400
-
-    for stress in data["stressDetails"]:
-        try:
-            user = User.get(
-                User.token["garmin"]["oauth_token"] == stress["userAccessToken"]
-            )
-        except (User.DoesNotExist, KeyError):
+def ingest_garmin_stresses(stresses):
+    """Upsert Garmin stress details in a single transaction"""
+    users = garmin_users(stresses)
+    rows = []
+    for stress in stresses:
+        user = users.get(stress.get("userAccessToken"))
+        if not user:
             current_app.logger.error(f"No user found for stress {stress}")
+            metrics.webhook("garmin", "stress", "skipped")
             continue
         # FIXME: check if we have those for stress
         if not stress.get("calendarDate"):
             current_app.logger.info("Ignoring stress payload w/o calendarDate: {sleep}")
+            metrics.webhook("garmin", "stress", "skipped")
             continue
         try:
-            day = Day.get_or_create(stress["calendarDate"], user, autosave=True)
             start = datetime.fromtimestamp(stress["startTimeInSeconds"])
             end = start + timedelta(seconds=stress["durationInSeconds"])
             kwargs = {
@@ -92,35 +128,90 @@ def api_stress_garmin():
                 kwargs["battery_values"] = battery_values
         except KeyError as e:
             current_app.logger.error(f"Missing data: {e} — {stress}")
-            return "Missing data", 400
-        else:
-            stress_obj = Stress.create_or_update(day, kwargs)
-            current_app.logger.debug(f"Updated stress {stress_obj.id}")
+            metrics.webhook("garmin", "stress", "skipped")
+            continue
+        rows.append((user, date.fromisoformat(stress["calendarDate"]), kwargs))
 
-    return "thanks :-)", 200
+    with db_wrapper.database.atomic():
+        Stress.bulk_create_or_update(attach_days(rows))
+    metrics.webhook("garmin", "stress", "processed", len(rows))
+    current_app.logger.debug(f"Updated {len(rows)} stresses")
 
 
-def api_sleep_withings():
-    """Not a real route, called from oauth.authorize for `notify` pattern"""
+def ingest_garmin_dailies(dailies):
+    """Upsert Garmin daily summaries and their rollups in a single transaction"""
+    users = garmin_users(dailies)
+    rows = []
+    for daily in dailies:
+        user = users.get(daily.get("userAccessToken"))
+        if not user:
+            current_app.logger.error(f"No user found for daily {daily}")
+            metrics.webhook("garmin", "daily", "skipped")
+            continue
+        if not daily.get("calendarDate"):
+            current_app.logger.info(f"Ignoring daily payload w/o calendarDate: {daily}")
+            metrics.webhook("garmin", "daily", "skipped")
+            continue
+        try:
+            kwargs = {
+                "duration_total": daily["durationInSeconds"],
+                "steps": daily.get("steps"),
+                "distance": daily.get("distanceInMeters"),
+                "active_kilocalories": daily.get("activeKilocalories"),
+                "bmr_kilocalories": daily.get("bmrKilocalories"),
+                "resting_heart_rate": daily.get("restingHeartRateInBeatsPerMinute"),
+                "heart_rate_values": daily.get("timeOffsetHeartRateSamples") or None,
+                "start": datetime.fromtimestamp(daily["startTimeInSeconds"]),
+                "offset": daily["startTimeOffsetInSeconds"],
+            }
+        except KeyError as e:
+            current_app.logger.error(f"Missing data: {e} — {daily}")
+            metrics.webhook("garmin", "daily", "skipped")
+            continue
+        rows.append((user, date.fromisoformat(daily["calendarDate"]), kwargs))
+
+    with db_wrapper.database.atomic():
+        Daily.bulk_create_or_update(attach_days(rows))
+    metrics.webhook("garmin", "daily", "processed", len(rows))
+    current_app.logger.debug(f"Updated {len(rows)} dailies")
+
+
+def withings_sleep_kwargs(serie, phases):
+    """Sleep fields from a withings summary serie, cf `withings-sleep-summary-payload.json`"""
+    tz = timezone(serie["timezone"])
+    start = datetime.fromtimestamp(serie["startdate"], tz=tz)
+    end = datetime.fromtimestamp(serie["enddate"], tz=tz)
+    return {
+        "duration_total":  serie["data"]["total_timeinbed"],
+        "duration_rem":  serie["data"]["remsleepduration"],
+        "duration_deep":  serie["data"]["deepsleepduration"],
+        "duration_awake":  serie["data"]["wakeupduration"],
+        "start": start.astimezone(utc),
+        "end": end.astimezone(utc),
+        "offset": start.utcoffset().seconds,
+        "phases": phases,
+    }
+
+
+def ingest_withings_sleep(user_id, start, end):
+    """Fetch and store withings sleeps for a notification window"""
     # circular dep (sorry)
-    from oauth import session_for_user
-    user_id = request.form["userid"]
-    start = request.form["startdate"]
-    end = request.form["enddate"]
-    user = User.get(User.token["withings"]["userid"] == user_id)
-
-    with session_for_user(user) as _oauth:
-        r = _oauth.withings.post("v2/sleep", data={
+    from oauth import withings_requests
+    user = User.get_by_credential("withings", user_id)
+
+    r, r_details = withings_requests(user, [
+        ("v2/sleep", {
             "action": "getsummary",
             "lastupdate": start,
-        })
-        r_details = _oauth.withings.post("v2/sleep", data={
+        }),
+        ("v2/sleep", {
             "startdate": start,
             "enddate": end,
             "action": "get",
-        })
-        r.raise_for_status()
-        r_details.raise_for_status()
+        }),
+    ])
+    r.raise_for_status()
+    r_details.raise_for_status()
 
     # cf `withings-sleep-summary-payload.json`
     data = r.json()
@@ -132,86 +223,384 @@ def api_sleep_withings():
     if details.get("status") != 0:
         raise Exception(f"api_sleep_withings(details) went wrong: {details}")
 
-    for serie in data.get("body", {}).get("series", []):
+    series = data.get("body", {}).get("series", [])
+    # the details cover the whole notification window, give each night its own segments
+    nights = split_phases(details.get("body", {}).get("series", []), [(s["startdate"], s["enddate"]) for s in series])
+    for (serie, phases) in zip(series, nights):
         day = Day.get_or_create(serie["date"], user, autosave=True)
-        tz = timezone(serie["timezone"])
-        start = datetime.fromtimestamp(serie["startdate"], tz=tz)
-        end = datetime.fromtimestamp(serie["enddate"], tz=tz)
-        kwargs = {
-            "duration_total":  serie["data"]["total_timeinbed"],
-            "duration_rem":  serie["data"]["remsleepduration"],
-            "duration_deep":  serie["data"]["deepsleepduration"],
-            "duration_awake":  serie["data"]["wakeupduration"],
-            "start": start.astimezone(utc),
-            "end": end.astimezone(utc),
-            "offset": start.utcoffset().seconds,
-            # we better _hope_ this is associated to the same date
-            "phases": details.get("body", {}).get("series", []),
-        }
+        kwargs = withings_sleep_kwargs(serie, phases)
+        # `lastupdate` also returns older nights, their stored phases are kept
+        if not (int(start) <= serie["startdate"] and serie["enddate"] <= int(end)):
+            del kwargs["phases"]
         sleep_obj = Sleep.create_or_update(day, "withings", kwargs)
+        metrics.webhook("withings", "sleep", "processed")
         current_app.logger.debug(f"Updated sleep {sleep_obj.id}")
 
+
+@bp.route("/sleep/garmin", methods=["POST"])
+def api_sleep_garmin():
+    data = request.json
+    if not data or not data.get("sleeps"):
+        current_app.logger.error(f"Malformed data: {request.text}")
+        metrics.webhook("garmin", "sleep", "rejected")
+        return "No sleeps json found", 400
+
+    metrics.webhook("garmin", "sleep", "received", len(data["sleeps"]))
+    Job.enqueue("garmin-sleep", data["sleeps"], key=lambda s: s.get("summaryId"))
+    return "thanks :-)", 200
+
+
+@bp.route("/stress/garmin", methods=["POST"])
+def api_stress_garmin():
+    data = request.json
+    if not data or not data.get("stressDetails"):
+        current_app.logger.error(f"Malformed data: {request.json}")
+        metrics.webhook("garmin", "stress", "rejected")
+        return "No stress json found", 400
+
+    metrics.webhook("garmin", "stress", "received", len(data["stressDetails"]))
+    Job.enqueue("garmin-stress", data["stressDetails"], key=lambda s: s.get("summaryId"))
+    return "thanks :-)", 200
+
+
+@bp.route("/dailies/garmin", methods=["POST"])
+def api_dailies_garmin():
+    data = request.json
+    if not data or not data.get("dailies"):
+        current_app.logger.error(f"Malformed data: {request.json}")
+        metrics.webhook("garmin", "daily", "rejected")
+        return "No dailies json found", 400
+
+    metrics.webhook("garmin", "daily", "received", len(data["dailies"]))
+    Job.enqueue("garmin-daily", data["dailies"], key=lambda d: d.get("summaryId"))
+    return "thanks :-)", 200
+
+
+def cached_response(view):
+    """Cache JSON responses per user, endpoint and arguments, keyed on the user's data version and the date
+
+    Clients revalidate with the ETag and get a 304 while nothing changed for them.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = (
+            current_user.id,
+            current_user.data_version,
+            request.endpoint,
+            tuple(sorted(kwargs.items())),
+            tuple(sorted(request.args.items(multi=True))),
+            # default ranges end today, cf `trends_api`
+            date.today(),
+        )
+        etag = hashlib.sha1(repr(key).encode()).hexdigest()
+        if not is_resource_modified(request.environ, etag=etag):
+            response = current_app.response_class(status=304)
+        elif cached := response_cache.get(key):
+            response = current_app.response_class(cached, mimetype="application/json")
+        else:
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                body = response.get_data()
+                response_cache.set(key, body, size=len(body))
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+    return wrapper
+
+
+def api_sleep_withings():
+    """Not a real route, called from oauth.authorize for `notify` pattern"""
+    try:
+        payload = {k: request.form[k] for k in ("userid", "startdate", "enddate")}
+    except KeyError as e:
+        current_app.logger.error(f"Missing data: {e} — {request.form}")
+        metrics.webhook("withings", "sleep", "rejected")
+        return "Missing data", 400
+
+    metrics.webhook("withings", "sleep", "received")
+    Job.enqueue(
+        "withings-sleep", [payload],
+        key=lambda p: f"{p['userid']}:{p['startdate']}:{p['enddate']}",
+    )
     return "ok", 200
 
 
-@auth_required
 @bp.route("/calendar")
+@auth_required()
+@cached_response
 def calendar():
     """Calendar data for a given timespan and data type"""
     cal = request.args["calendar"]
     start = datetime.fromisoformat(request.args["start"]).astimezone(utc)
     end = datetime.fromisoformat(request.args["end"]).astimezone(utc)
     days = Day.select().where(
+        Day.user == current_user.id,
         Day.date >= start,
         Day.date < end + timedelta(days=1)
     )
 
-    data = {}
+    data = []
     if cal == "sleep":
+        scores = days.select(Day.date, Day.sleep_score_value).where(Day.sleep_score_value.is_null(False))
         data = [{
-            "id": f"sleep-{d.date}",
-            "start": d.date.isoformat(),
-            "title": f"😴 {d.sleep_score()}",
-            "value": d.sleep_score(),
-            "url": url_for("day_summary", day=d.date),
-        } for d in days if d.sleeps]
+            "id": f"sleep-{d}",
+            "start": d.isoformat(),
+            "title": f"😴 {value}",
+            "value": value,
+            "url": url_for("day_summary", day=d),
+        } for (d, value) in scores.tuples()]
     elif cal == "stress":
+        scores = days.select(Day.date, Day.battery_score_value).where(Day.battery_score_value.is_null(False))
         data = [{
-            "id": f"stress-{d.date}",
-            "start": d.date.isoformat(),
-            "title": f"⚡️ {d.battery_score()}",
-            "value": d.battery_score(),
-            "url": url_for("day_summary", day=d.date),
-        } for d in days if d.stresses]
+            "id": f"stress-{d}",
+            "start": d.isoformat(),
+            "title": f"⚡️ {value}",
+            "value": value,
+            "url": url_for("day_summary", day=d),
+        } for (d, value) in scores.tuples()]
     elif cal == "mood":
         data = [{
-            "id": f"mood-{d.date}",
-            "start": d.date.isoformat(),
+            "id": f"mood-{d}",
+            "start": d.isoformat(),
             "title": "📝 Journal",
-            "url": url_for("day_view", day=d.date),
-        } for d in days if d.tiredness_morning]
+            "url": url_for("day_view", day=d),
+        } for (d, tiredness) in days.select(Day.date, Day.tiredness_morning).tuples() if tiredness]
+
+    return json_response(data)
 
-    return jsonify(data)
 
+@bp.route("/trends")
+@auth_required()
+@cached_response
+def trends_api():
+    """Moving averages, week-over-week deltas and percentiles, for the last 90 days by default"""
+    args = request.args
+    end = datetime.fromisoformat(args["end"]).date() if "end" in args else date.today()
+    start = datetime.fromisoformat(args["start"]).date() if "start" in args else end - timedelta(days=89)
+    names = args["metrics"].split(",") if "metrics" in args else list(trends.METRICS)
+    if start > end or any(m not in trends.METRICS for m in names):
+        abort(400)
+    return json_response(trends.trends(current_user.id, start, end, names))
 
-def serialize_day(day):
-    return model_to_dict(day, backrefs=True, exclude=(Day.user, ))
+
+@bp.route("/insights")
+@auth_required()
+@cached_response
+def insights_api():
+    """Journal factors against the sleep outcomes, from the running moments of `Moments`"""
+    data = {outcome: {} for outcome in INSIGHT_OUTCOMES}
+    for moments in Moments.select().where(Moments.user == current_user.id).order_by(Moments.factor):
+        data[moments.outcome][moments.factor] = moments.insight()
+    return json_response(data)
+
+
+# longest range (days) served from each tier, cf `series_api`
+SERIES_TIERS = (("raw", 2), ("hour", 62), ("day", None))
+
+
+@bp.route("/series/<any(heart_rate, steps):metric>")
+@auth_required()
+@cached_response
+def series_api(metric):
+    """Heart rate or steps over a range, from the raw samples or the rollups depending on its length
+
+    `tier` (raw, hour or day) can be forced. Points are columns, local times.
+    """
+    start = datetime.fromisoformat(request.args["start"]).date()
+    end = datetime.fromisoformat(request.args["end"]).date()
+    tier = request.args.get("tier") or next(
+        t for (t, days) in SERIES_TIERS if days is None or (end - start).days < days
+    )
+    days = Day.select(Day.id).where(Day.user == current_user.id, Day.date.between(start, end))
+
+    if tier == "raw":
+        field = getattr(Daily, f"{metric}_values")
+        times, values = [], []
+        query = Daily.select(Day.date, field).join(Day).where(Daily.day.in_(days)).order_by(Day.date)
+        for (day, series) in query.tuples():
+            # offsets are from local midnight
+            midnight = datetime.combine(day, datetime.min.time())
+            times += [midnight + timedelta(seconds=o) for o in series.offsets]
+            values += list(series.values())
+        return json_response({"tier": tier, "time": times, "value": values})
+    if tier not in Rollup.TIERS:
+        abort(400)
+    query = Rollup.select(Rollup.start, Rollup.count, Rollup.min, Rollup.max, Rollup.mean, Rollup.total).where(
+        Rollup.day.in_(days), Rollup.metric == metric, Rollup.tier == tier,
+    ).order_by(Rollup.start)
+    columns = list(zip(*query.tuples())) or [()] * 6
+    return json_response({"tier": tier, **dict(zip(("time", "count", "min", "max", "mean", "total"), columns))})
+
+
+# without the owner and the bookkeeping of `Moments`
+DAY_FIELDS = [f for f in Day._meta.sorted_fields if f.name not in ("user", "insight_sample")]
+# compact bytea decoded in python, not selected at all for `series=none`
+SERIES_FIELDS = {Sleep.phases, Stress.stress_values, Stress.battery_values}
+
+
+def related_rows(model, day_ids, series=True):
+    """`model` rows of `day_ids` as dicts, grouped by day id"""
+    fields = [f for f in model._meta.sorted_fields if f is not model.day and (series or f not in SERIES_FIELDS)]
+    rows = {}
+    query = model.select(model.day, *fields).where(model.day.in_(day_ids)).order_by(model.id).dicts()
+    for row in query:
+        rows.setdefault(row.pop("day"), []).append(row)
+    return rows
+
+
+def day_rows(days, series=True):
+    """Days as dicts with their sleeps and stresses, without building model instances"""
+    days = list(days.select(*DAY_FIELDS).dicts())
+    ids = [d["id"] for d in days]
+    sleeps, stresses = related_rows(Sleep, ids, series), related_rows(Stress, ids, series)
+    for day in days:
+        day["sleeps"] = sleeps.get(day["id"], [])
+        day["stresses"] = stresses.get(day["id"], [])
+    return days
+
+
+def with_series():
+    """Clients not needing sleep phases and stress timeseries can skip them with `series=none`"""
+    return request.args.get("series", "full") != "none"
 
 
-@auth_required
 @bp.route("/day/<isodate:day>")
+@auth_required()
+@cached_response
 def day_api(day):
-    day = get_object_or_404(Day, (Day.date == day))
-    return jsonify(serialize_day(day))
+    rows = day_rows(Day.select().where(Day.user == current_user.id, Day.date == day), with_series())
+    if not rows:
+        abort(404)
+    return json_response(rows[0])
 
 
-@auth_required
 @bp.route("/days")
+@auth_required()
+@cached_response
 def days_api():
     start = datetime.fromisoformat(request.args["start"]).astimezone(utc)
     end = datetime.fromisoformat(request.args["end"]).astimezone(utc)
     days = Day.select().where(
+        Day.user == current_user.id,
         Day.date >= start,
         Day.date < end + timedelta(days=1)
     )
-    return jsonify([serialize_day(d) for d in days])
+
+    fmt = request.args.get("format", "json")
+    if fmt == "ndjson":
+        rows = (json.dumps(d) + "\n" for d in iter_days(days, with_series()))
+        return current_app.response_class(stream_with_context(rows), mimetype="application/x-ndjson")
+    elif fmt == "csv":
+        return current_app.response_class(stream_with_context(days_csv(days)), mimetype="text/csv")
+    return json_response(day_rows(days.order_by(Day.date), with_series()))
+
+
+def iter_days(days, series=True, chunk_size=EXPORT_CHUNK_SIZE):
+    """Iterate over `days` rows by date in chunks, cf `day_rows`"""
+    last = None
+    while True:
+        chunk = days.order_by(Day.date).limit(chunk_size)
+        if last:
+            chunk = chunk.where(Day.date > last)
+        chunk = day_rows(chunk, series)
+        yield from chunk
+        if len(chunk) < chunk_size:
+            return
+        last = chunk[-1]["date"]
+
+
+DAY_CSV_FIELDS = [
+    "date", "notes", "alcohol_doses", "mood", "tiredness_morning", "tiredness_evening",
+    "nap_minutes", "office", "vacation", "sleep_score_value", "battery_score_value",
+]
+SLEEP_CSV_FIELDS = ["duration_total", "duration_rem", "duration_deep", "duration_awake"]
+
+
+def days_csv(days):
+    """One CSV line per day, with journal, scores and per provider sleep durations"""
+    providers = list(SLEEP_PHASES_CONFIG)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return line
+
+    writer.writerow(DAY_CSV_FIELDS + [f"{p}_{f}" for p in providers for f in SLEEP_CSV_FIELDS])
+    yield flush()
+    for day in iter_days(days, series=False):
+        sleeps = {s["provider"]: s for s in day["sleeps"]}
+        writer.writerow(
+            [day[f] for f in DAY_CSV_FIELDS]
+            + [sleeps[p][f] if p in sleeps else None for p in providers for f in SLEEP_CSV_FIELDS]
+        )
+        yield flush()
+
+
+def conditional_response(rows, build):
+    """JSON response with ETag/Last-Modified from `(id, updated_at)` rows, 304 if unchanged
+
+    `build` is only called when the client copy is stale.
+    """
+    rows = sorted(rows)
+    etag = hashlib.sha1(repr(rows).encode()).hexdigest()
+    last_modified = max((updated_at for (_, updated_at) in rows), default=None)
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = current_app.response_class(status=304)
+    else:
+        response = json_response(build())
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+@bp.route("/day/<isodate:day>/sleep-series")
+@auth_required()
+def day_sleep_series(day):
+    """Sleep phases as parallel arrays: start `t`, end `e`, phase `v` (index of `labels`)"""
+    day = get_object_or_404(Day, (Day.user == current_user.id) & (Day.date == day))
+    rows = Sleep.select(Sleep.id, Sleep.updated_at).where(Sleep.day == day).tuples()
+
+    def build():
+        sleeps = {s.provider: s for s in Sleep.select().where(Sleep.day == day)}
+        series = []
+        for (provider, config) in SLEEP_PHASES_CONFIG.items():
+            if provider not in sleeps:
+                continue
+            starts, ends, states = phase_intervals(sleeps[provider].phases, provider)
+            series.append({
+                "provider": provider,
+                "labels": [c["name"] for c in config],
+                "colors": [c["color"] for c in config],
+                "t": starts.tolist(),
+                "e": ends.tolist(),
+                "v": states.tolist(),
+            })
+        return series
+
+    return conditional_response(rows, build)
+
+
+@bp.route("/day/<isodate:day>/stress-series")
+@auth_required()
+def day_stress_series(day):
+    """Stress and battery as parallel arrays: offset from `start` (seconds) `t`, value `v`"""
+    day = get_object_or_404(Day, (Day.user == current_user.id) & (Day.date == day))
+    rows = Stress.select(Stress.id, Stress.updated_at).where(Stress.day == day).tuples()
+
+    def build():
+        stress = Stress.select().where(Stress.day == day).first()
+        if not stress:
+            return {}
+        return {
+            "start": int(stress.start.timestamp()),
+            "battery": {"t": list(stress.battery_values.offsets), "v": list(stress.battery_values.values())},
+            "stress": {"t": list(stress.stress_values.offsets), "v": list(stress.stress_values.values())},
+        }
+
+    return conditional_response(rows, build)
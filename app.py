@@ -1,21 +1,22 @@
-import json
-
 from datetime import date, timedelta
 
 import sentry_sdk
 
-from flask import Flask, render_template, url_for, redirect, request
+from flask import Flask, jsonify, render_template, url_for, redirect, request
+from flask.logging import default_handler
 from flask_security import Security, auth_required, current_user
 from sentry_sdk.integrations.flask import FlaskIntegration
 from werkzeug.exceptions import NotFound
 
+import instrumentation
+import metrics
 import oauth
 import settings
 
 from api import bp as api_bp
 from cli import bp as cli_bp
-from models import Day, init_app as init_models
-from utils import ISODateConverter, ISODateJSONEncoder
+from models import Day, Moments, User, init_app as init_models, pool_stats
+from utils import ISODateConverter, ORJSONProvider
 
 if sentry_dsn := settings.SENTRY_DSN:
     sentry_sdk.init(
@@ -26,12 +27,20 @@ if sentry_dsn := settings.SENTRY_DSN:
 
 
 app = Flask(__name__)
-app.json_encoder = ISODateJSONEncoder
+# wrapped by Flask-Security for its lazy strings, cf `Security`
+app.json_provider_class = ORJSONProvider
+app.json = ORJSONProvider(app)
 app.config.from_pyfile("settings.py")
+# Flask's default handler writes to stderr (gunicorn's error log), the logger is WARNING until configured
+app.logger.setLevel(app.config["LOG_LEVEL"])
+if not app.logger.handlers:
+    app.logger.addHandler(default_handler)
 
 
 init_models(app)
 oauth.init_app(app)
+instrumentation.init_app(app)
+metrics.init_app(app)
 security = Security(app, app.user_datastore)
 
 app.url_map.converters["isodate"] = ISODateConverter
@@ -44,6 +53,12 @@ def index():
     return render_template("index.html")
 
 
+@app.route("/health")
+def health():
+    """Liveness and DB pool gauges for this worker process"""
+    return jsonify({"status": "ok", "pool": pool_stats()})
+
+
 @app.route("/legal")
 def legal():
     return render_template("legal.html")
@@ -58,10 +73,10 @@ def account():
 @app.route("/debug")
 @auth_required()
 def debug_page():
-    r = oauth.oauth.withings.post("notify", data={
+    [r] = oauth.withings_requests(current_user, [("notify", {
         "action": "list",
         # "appli": 44,
-    })
+    })])
     return render_template("debug.html", payload=r.json())
 
 
@@ -82,9 +97,6 @@ def day_view(day):
     day = Day.get_or_create(day, current_user)
 
     if request.method == "POST":
-        # save "proxy" freshly created Day if needed
-        if day.is_dirty():
-            day.save()
         kwargs = {
             "notes": request.form.get("notes"),
             "alcohol_doses": request.form.get("alcohol_doses") or None,
@@ -95,7 +107,14 @@ def day_view(day):
             "office": request.form.get("office") == "yes",
             "vacation": request.form.get("vacation") == "yes",
         }
-        Day.update(**kwargs).where(Day.id == day.id).execute()
+        # the insights lock first, cf `Moments.lock`
+        with Moments.lock([current_user.id]):
+            # save "proxy" freshly created Day if needed
+            if day.is_dirty():
+                day.save()
+            Day.update(**kwargs).where(Day.id == day.id).execute()
+            Moments.record([day.id])
+        User.bump_data_version([current_user.id])
         return redirect(request.url)
 
     return render_template("day.html", day=day, today=date.today())
@@ -111,7 +130,7 @@ def day_summary_today():
 @auth_required()
 def day_summary(day):
     try:
-        day = Day.get(date=day)
+        day = Day.get(user=current_user.id, date=day)
     except Day.DoesNotExist:
         raise NotFound
 
@@ -134,77 +153,3 @@ def is_vacation(day):
     if day.vacation is None and day.date.isoweekday() in [6, 7]:
         return True
     return day.vacation
-
-
-@app.template_filter("sleep_timeseries")
-def sleep_timeseries(phases, provider):
-    """Datasets for timeseries chart"""
-    datasets = []
-    filled = fill_phases(phases, provider)
-    if provider == "withings":
-        config = [
-            {"name": "Awake", "color": "#F94144"},
-            {"name": "Léger", "color": "#F9C74F"},
-            {"name": "Profond", "color": "#277DA1"},
-            {"name": "REM", "color": "#F9844A"},
-            {"name": "Manuel", "color": "light-grey"},
-            {"name": "Non spécifié", "color": "white"},
-        ]
-        for (i, conf) in enumerate(config):
-            datasets.append({
-                "label": conf["name"],
-                "backgroundColor": conf["color"],
-                "barPercentage": 1,
-                "categoryPercentage": 1,
-                "inflateAmount": 2,
-                "data": [{"x": f["startdate"] * 1000, "y": 1} for f in filled if f["state"] == i],
-            })
-    elif provider == "garmin":
-        config = [
-            {"id": "awake", "name": "Awake", "color": "#F94144"},
-            {"id": "light", "name": "Léger", "color": "#F9C74F"},
-            {"id": "deep", "name": "Profond", "color": "#277DA1"},
-            {"id": "rem", "name": "REM", "color": "#F9844A"},
-        ]
-        datasets = []
-        for conf in config:
-            this_phase = phases.get(conf["id"], [])
-            data = []
-            for phase in this_phase:
-                current = phase["startTimeInSeconds"]
-                while current <= phase["endTimeInSeconds"]:
-                    data.append({
-                        "x": current * 1000,
-                        "y": 1
-                    })
-                    current += 60
-            datasets.append({
-                "label": conf["name"],
-                "backgroundColor": conf["color"],
-                "barPercentage": 1,
-                "categoryPercentage": 1,
-                "inflateAmount": 2,
-                "data": data,
-            })
-
-    return json.dumps(datasets)
-
-
-def fill_phases(values, provider):
-    if provider == "withings":
-        """Fill in increment of 1 minute to have a filled bar chart"""
-        _values = []
-        for value in values:
-            current_date = value["startdate"]
-            while current_date <= value["enddate"]:
-                # minutes increments
-                next_date = current_date + 60
-                _values.append({
-                    "startdate": current_date,
-                    "enddate": next_date,
-                    "state": value["state"],
-                })
-                current_date = next_date
-        return _values
-
-    return values
@@ -0,0 +1,145 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+from urllib.parse import urljoin
+
+from flask import current_app
+from pytz import utc
+
+import settings
+
+from api import attach_days, withings_sleep_kwargs
+from models import Job, Moments, Sleep, User
+from oauth import oauth, withings_request, withings_session
+from utils import RateLimiter
+
+# days per window, Garmin backfill requests are limited to 90 days
+WINDOW_DAYS = {"withings": 30, "garmin": 90}
+# pushed to the webhooks by Garmin once requested
+GARMIN_SUMMARIES = ("sleeps", "stressDetails")
+garmin_rate = RateLimiter(settings.GARMIN_RATE_LIMIT)
+
+
+def windows(since, until, days):
+    """Consecutive `(start, end)` date windows of at most `days` days covering since..until"""
+    start = since
+    while start <= until:
+        end = min(start + timedelta(days=days - 1), until)
+        yield (start, end)
+        start = end + timedelta(days=1)
+
+
+def withings_json(r):
+    r.raise_for_status()
+    data = r.json()
+    if data.get("status") != 0:
+        raise Exception(f"withings backfill went wrong: {data}")
+    return data["body"]
+
+
+def fetch_withings(session, base_url, start, end):
+    """`(date, Sleep kwargs)` of the window's nights, each with its own phases"""
+    url = urljoin(base_url, "v2/sleep")
+    series, offset = [], 0
+    while True:
+        body = withings_json(withings_request(session, url, {
+            "action": "getsummary",
+            "startdateymd": start.isoformat(),
+            "enddateymd": end.isoformat(),
+            "offset": offset,
+        }))
+        series += body.get("series", [])
+        if not body.get("more"):
+            break
+        offset = body["offset"]
+
+    rows = []
+    # details are limited to 24h per call, fetch them per night
+    for serie in series:
+        details = withings_json(withings_request(session, url, {
+            "action": "get",
+            "startdate": serie["startdate"],
+            "enddate": serie["enddate"],
+        }))
+        rows.append((date.fromisoformat(serie["date"]), withings_sleep_kwargs(serie, details.get("series", []))))
+    return rows
+
+
+def request_garmin(client, token, start, end):
+    """Ask Garmin to push the window's summaries, a 409 means it was already requested"""
+    params = {
+        "summaryStartTimeInSeconds": int(utc.localize(datetime.combine(start, datetime.min.time())).timestamp()),
+        "summaryEndTimeInSeconds": int(utc.localize(datetime.combine(end, datetime.max.time())).timestamp()),
+    }
+    for summary in GARMIN_SUMMARIES:
+        garmin_rate.acquire()
+        r = client.get(f"backfill/{summary}", params=params, token=token)
+        if r.status_code != 409:
+            r.raise_for_status()
+    # data comes back through `api_sleep_garmin` / `api_stress_garmin`
+    return []
+
+
+def fetcher(user, provider):
+    """Window fetch function, safe to run in other threads, built (and token refreshed) in the app context"""
+    if provider == "withings":
+        session, base_url = withings_session(user), oauth.withings.api_base_url
+        return lambda start, end: fetch_withings(session, base_url, start, end)
+    client, token = oauth.garmin, user.token["garmin"]
+    return lambda start, end: request_garmin(client, token, start, end)
+
+
+def store(user, provider, rows):
+    if provider == "withings" and rows:
+        with Moments.lock([user.id]):
+            Sleep.bulk_create_or_update(provider, attach_days([(user, day, kwargs) for (day, kwargs) in rows]))
+
+
+def run_window(payload):
+    """Job handler, finishes the windows a `flask backfill` run could not"""
+    user = User.get_by_id(payload["user_id"])
+    fetch = fetcher(user, payload["provider"])
+    store(user, payload["provider"], fetch(date.fromisoformat(payload["start"]), date.fromisoformat(payload["end"])))
+
+
+def run(user, provider, since, until=None, concurrency=4, restart=False):
+    """Fetch `provider` history of `user`, `concurrency` windows at a time
+
+    Windows are checkpointed as jobs, done ones are skipped on the next runs (unless `restart`, or once purged
+    after `JOB_RETENTION`) and the failed ones are retried by the job worker. Returns the number of done and
+    failed windows.
+    """
+    config = current_app.config
+    kind = f"{provider}-backfill"
+    payloads = [
+        {"user_id": user.id, "provider": provider, "start": start.isoformat(), "end": end.isoformat()}
+        for (start, end) in windows(since, until or date.today(), WINDOW_DAYS[provider])
+    ]
+    keys = [f"{p['user_id']}:{p['start']}:{p['end']}" for p in payloads]
+    Job.enqueue(kind, payloads, key=lambda p: f"{p['user_id']}:{p['start']}:{p['end']}", once=True)
+    if restart:
+        Job.update(status="pending", attempts=0, run_at=datetime.utcnow()).where(
+            Job.kind == kind, Job.key.in_(keys)
+        ).execute()
+
+    done = failed = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while jobs := Job.claim(concurrency, 300, Job.kind == kind, Job.key.in_(keys)):
+            fetch = fetcher(user, provider)
+            futures = {
+                executor.submit(fetch, date.fromisoformat(j.payload["start"]), date.fromisoformat(j.payload["end"])): j
+                for j in jobs
+            }
+            # fetches run in parallel, writes happen here, in the app context
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    store(user, provider, future.result())
+                except Exception as e:
+                    current_app.logger.exception(f"Backfill window {job.key} failed: {e}")
+                    job.retry(e, max_attempts=config["JOB_MAX_ATTEMPTS"], delay=config["JOB_RETRY_DELAY"])
+                    failed += 1
+                else:
+                    Job.complete([job])
+                    done += 1
+                    current_app.logger.info(f"Backfill window {job.key} done")
+    return done, failed
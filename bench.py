@@ -0,0 +1,297 @@
+import json
+import random
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from itertools import count
+from pathlib import Path
+from statistics import quantiles
+
+from flask_security import hash_password
+from peewee import Proxy
+
+import api
+import worker
+
+from models import Credential, Daily, Day, Job, Rollup, Sleep, Stress, User, db_wrapper
+
+DATA_DIR = Path(__file__).parent / "data"
+# results of `flask bench --save`, compared with each run
+BASELINE = Path(__file__).parent / "bench-baseline.json"
+BENCH_EMAIL = "bench-{}@bench.local"
+BENCH_PASSWORD = "bench-password"
+
+
+def fixture(name):
+    return json.loads((DATA_DIR / name).read_text())
+
+
+# Synthetic payloads, built from the recorded ones in `data/`
+
+def garmin_sleep(token, day, rng):
+    """Daily sleep summary shaped like `garmin-non-daily-sleep-payload.json` + daily fields"""
+    base = fixture("garmin-non-daily-sleep-payload.json")
+    start = int(datetime.combine(day - timedelta(days=1), datetime.min.time()).timestamp()) + 23 * 3600
+    duration = rng.randint(6 * 3600, 9 * 3600)
+    durations = {
+        "deep": int(duration * rng.uniform(.1, .2)),
+        "rem": int(duration * rng.uniform(.15, .25)),
+        "awake": int(duration * rng.uniform(0, .05)),
+    }
+    durations["light"] = duration - sum(durations.values())
+    levels, current = {level: [] for level in durations}, start
+    # a few cycles through the phases
+    for _ in range(4):
+        for (level, total) in durations.items():
+            levels[level].append({"startTimeInSeconds": current, "endTimeInSeconds": current + total // 4})
+            current += total // 4
+    return {
+        **base,
+        "userAccessToken": token,
+        "summaryId": f"bench-sleep-{token}-{day}",
+        "calendarDate": day.isoformat(),
+        "startTimeInSeconds": start,
+        "durationInSeconds": duration,
+        "deepSleepDurationInSeconds": durations["deep"],
+        "remSleepInSeconds": durations["rem"],
+        "awakeDurationInSeconds": durations["awake"],
+        "lightSleepDurationInSeconds": durations["light"],
+        "sleepLevelsMap": levels,
+    }
+
+
+def garmin_stress(token, day, rng):
+    """Stress details at 3 minutes resolution, values patterned on `garmin-daily-summary.json`"""
+    summary = fixture("garmin-daily-summary.json")[0]
+    pattern = list(summary["timeOffsetHeartRateSamples"].values())
+    start = int(datetime.combine(day, datetime.min.time()).timestamp())
+    offsets = range(0, 86400, 180)
+    return {
+        "userAccessToken": token,
+        "summaryId": f"bench-stress-{token}-{day}",
+        "calendarDate": day.isoformat(),
+        "startTimeInSeconds": start,
+        "startTimeOffsetInSeconds": summary["startTimeOffsetInSeconds"],
+        "durationInSeconds": 86400,
+        "timeOffsetStressLevelValues": {
+            str(o): pattern[i % len(pattern)] - 30 + rng.randint(-5, 5) for (i, o) in enumerate(offsets)
+        },
+        "timeOffsetBodyBatteryValues": {
+            str(o): max(5, 100 - i // 6 + rng.randint(-3, 3)) for (i, o) in enumerate(offsets)
+        },
+    }
+
+
+def garmin_daily(token, day, rng):
+    """Whole day summary shaped like `garmin-daily-summary.json`, heart rate every 15 seconds"""
+    base = fixture("garmin-daily-summary.json")[1]
+    pattern = list(base["timeOffsetHeartRateSamples"].values())
+    return {
+        **base,
+        "userAccessToken": token,
+        "summaryId": f"bench-daily-{token}-{day}",
+        "calendarDate": day.isoformat(),
+        "startTimeInSeconds": int(datetime.combine(day, datetime.min.time()).timestamp()),
+        "startTimeOffsetInSeconds": 0,
+        "durationInSeconds": 86400,
+        "steps": rng.randint(2000, 15000),
+        "timeOffsetHeartRateSamples": {
+            str(o): pattern[i % len(pattern)] + rng.randint(-3, 3) for (i, o) in enumerate(range(15, 86401, 15))
+        },
+    }
+
+
+def withings_sleep(day):
+    """Withings summary serie and its phases, shifted from the recorded night to `day`"""
+    serie = fixture("withings-sleep-summary-payload.json")["body"]["series"][0]
+    details = fixture("withings-sleep-details-payload.json")["body"]["series"]
+    shift = int((day - date.fromisoformat(serie["date"])).total_seconds())
+    phases = [{**p, "startdate": p["startdate"] + shift, "enddate": p["enddate"] + shift} for p in details]
+    start = datetime.utcfromtimestamp(serie["startdate"] + shift)
+    return {
+        "duration_total": serie["data"]["total_timeinbed"],
+        "duration_rem": serie["data"]["remsleepduration"],
+        "duration_deep": serie["data"]["deepsleepduration"],
+        "duration_awake": serie["data"]["wakeupduration"],
+        "start": start,
+        "end": start + timedelta(seconds=serie["enddate"] - serie["startdate"]),
+        "offset": 3600,
+        "phases": phases,
+    }
+
+
+# Measurements
+
+@contextmanager
+def count_queries(counter):
+    database = db_wrapper.database
+    if isinstance(database, Proxy):
+        database = database.obj
+    execute_sql = database.execute_sql
+
+    def counting(*args, **kwargs):
+        counter[0] += 1
+        return execute_sql(*args, **kwargs)
+
+    database.execute_sql = counting
+    try:
+        yield counter
+    finally:
+        database.execute_sql = execute_sql
+
+
+def ok(response):
+    """Fail the case on an error response, instead of timing it"""
+    if response.status_code != 200:
+        raise RuntimeError(f"{response.request.method} {response.request.path}: {response.status}")
+    return response
+
+
+def measure(func, repeat):
+    """Latency percentiles (ms), queries per call and peak traced memory (KiB) of `func()`"""
+    timings, counter = [], [0]
+    with count_queries(counter):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - start) * 1000)
+    # separate run, tracing slows everything down
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    p50, p95, p99 = (quantiles(timings, n=100, method="inclusive")[i] for i in (49, 94, 98)) \
+        if len(timings) > 1 else timings * 3
+    return {
+        "p50_ms": round(p50, 3),
+        "p95_ms": round(p95, 3),
+        "p99_ms": round(p99, 3),
+        "queries": round(counter[0] / repeat, 1),
+        "peak_kib": round(peak / 1024, 1),
+    }
+
+
+# Setup / teardown of the synthetic users
+
+def setup(app, users, days, seed=0):
+    rng = random.Random(seed)
+    ds = app.user_datastore
+    first_day = date.today() - timedelta(days=days)
+    accounts = []
+    for n in range(users):
+        user = ds.create_user(email=BENCH_EMAIL.format(n), password=hash_password(BENCH_PASSWORD))
+        token = f"bench-{n}"
+        user.set_token("garmin", {"oauth_token": token, "oauth_token_secret": token})
+        accounts.append((user, token))
+
+    for (user, token) in accounts:
+        dates = [first_day + timedelta(days=i) for i in range(days)]
+        api.ingest_garmin_sleeps([garmin_sleep(token, d, rng) for d in dates])
+        api.ingest_garmin_stresses([garmin_stress(token, d, rng) for d in dates])
+        api.ingest_garmin_dailies([garmin_daily(token, d, rng) for d in dates])
+        rows = [(user, d, withings_sleep(d)) for d in dates]
+        with db_wrapper.database.atomic():
+            Sleep.bulk_create_or_update("withings", api.attach_days(rows))
+    return accounts, first_day
+
+
+def teardown():
+    users = User.select(User.id).where(User.email.endswith("@bench.local"))
+    days = Day.select(Day.id).where(Day.user.in_(users))
+    Sleep.delete().where(Sleep.day.in_(days)).execute()
+    Stress.delete().where(Stress.day.in_(days)).execute()
+    Daily.delete().where(Daily.day.in_(days)).execute()
+    Rollup.delete().where(Rollup.day.in_(days)).execute()
+    Day.delete().where(Day.id.in_(days)).execute()
+    Credential.delete().where(Credential.user.in_(users)).execute()
+    Job.delete().where(Job.key.startswith("bench-")).execute()
+    User.delete().where(User.id.in_(users)).execute()
+
+
+def run(app, users=3, years=2, repeat=20, batch=100):
+    results = {}
+    days = 365 * years
+    rng = random.Random(1)
+    with app.app_context():
+        teardown()
+        accounts, first_day = setup(app, users, days)
+        (user, token) = accounts[0]
+        db_wrapper.database.close()
+
+        # webhook ingest, request + worker drain of `batch` summaries
+        # requests get a fresh app context (and `g`), the outer one lives as long as the command
+        client = app.test_client()
+        calls = count()
+
+        def ingest(kind, route, build):
+            def call():
+                n = next(calls)
+                payload = [{
+                    **build(token, first_day + timedelta(days=(n * batch + i) % days), rng),
+                    # unique job keys, days are upserted again once wrapped around
+                    "summaryId": f"bench-{kind}-{n}-{i}",
+                } for i in range(batch)]
+                with app.app_context():
+                    ok(client.post(route, json={kind: payload}))
+                # only the bench jobs, not the ones of real webhooks
+                worker.run_jobs(Job.claim(batch, 300, Job.key.startswith("bench-")))
+                # requests open their own connection on this thread
+                db_wrapper.database.close()
+            return call
+
+        results["ingest_garmin_sleep"] = measure(ingest("sleeps", "/api/sleep/garmin", garmin_sleep), repeat)
+        results["ingest_garmin_stress"] = measure(ingest("stressDetails", "/api/stress/garmin", garmin_stress), repeat)
+        results["ingest_garmin_daily"] = measure(ingest("dailies", "/api/dailies/garmin", garmin_daily), repeat)
+
+        # scoring, no DB
+        sleeps = [Sleep(**withings_sleep(first_day + timedelta(days=i))) for i in range(days)]
+        results["computed_score"] = measure(lambda: [s.computed_score() for s in sleeps], repeat)
+        # batch rescoring of a year of days, cf `scoring`
+        ids = [id for (id,) in Day.select(Day.id).where(Day.user == user).order_by(Day.date.desc()).limit(365).tuples()]
+        results["refresh_scores_year"] = measure(lambda: Day.refresh_scores(ids), max(repeat // 4, 2))
+        db_wrapper.database.close()
+
+        # read APIs, logged in as the first bench user, response cache cleared on each call
+        with client.session_transaction() as session:
+            session["_user_id"] = user.fs_uniquifier
+            session["_fresh"] = True
+        month = {"start": (date.today() - timedelta(days=35)).isoformat(), "end": date.today().isoformat()}
+        year = {"start": (date.today() - timedelta(days=365)).isoformat(), "end": date.today().isoformat()}
+
+        def get(path, **params):
+            def call():
+                api.response_cache.clear()
+                with app.app_context():
+                    ok(client.get(path, query_string=params)).get_data()
+            return call
+
+        results["calendar_sleep_month"] = measure(get("/api/calendar", calendar="sleep", **month), repeat)
+        results["calendar_stress_month"] = measure(get("/api/calendar", calendar="stress", **month), repeat)
+        results["days_month"] = measure(get("/api/days", **month), repeat)
+        results["days_year"] = measure(get("/api/days", **year), max(repeat // 4, 2))
+        yesterday = (date.today() - timedelta(days=1)).isoformat()
+        results["sleep_series_day"] = measure(get(f"/api/day/{yesterday}/sleep-series"), repeat)
+        results["heart_rate_day_raw"] = measure(get("/api/series/heart_rate", start=yesterday, end=yesterday), repeat)
+        results["heart_rate_month_hourly"] = measure(get("/api/series/heart_rate", **month), repeat)
+        results["heart_rate_year_daily"] = measure(get("/api/series/heart_rate", **year), repeat)
+        results["days_year_ndjson"] = measure(get("/api/days", format="ndjson", **year), max(repeat // 4, 2))
+
+        teardown()
+        db_wrapper.database.close()
+    return results
+
+
+def compare(results, baseline):
+    """Lines of `case metric: baseline -> current (delta %)`"""
+    lines = []
+    for (case, metrics) in results.items():
+        for (metric, value) in metrics.items():
+            before = baseline.get(case, {}).get(metric)
+            if before is None:
+                lines.append(f"{case} {metric}: {value} (new)")
+                continue
+            delta = (value - before) / before * 100 if before else 0
+            lines.append(f"{case} {metric}: {before} -> {value} ({delta:+.1f}%)")
+    return lines
@@ -0,0 +1,37 @@
+import numpy as np
+
+
+SLEEP_PHASES_CONFIG = {
+    # index is withings `state`
+    "withings": [
+        {"name": "Awake", "color": "#F94144"},
+        {"name": "Léger", "color": "#F9C74F"},
+        {"name": "Profond", "color": "#277DA1"},
+        {"name": "REM", "color": "#F9844A"},
+        {"name": "Manuel", "color": "light-grey"},
+        {"name": "Non spécifié", "color": "white"},
+    ],
+    # index is the position in garmin `sleepLevelsMap`
+    "garmin": [
+        {"id": "awake", "name": "Awake", "color": "#F94144"},
+        {"id": "light", "name": "Léger", "color": "#F9C74F"},
+        {"id": "deep", "name": "Profond", "color": "#277DA1"},
+        {"id": "rem", "name": "REM", "color": "#F9844A"},
+    ],
+}
+
+
+def phase_intervals(phases, provider):
+    """Phases as `(starts, ends, states)` arrays, states index `SLEEP_PHASES_CONFIG[provider]`"""
+    if provider == "withings":
+        rows = [(p["startdate"], p["enddate"], p["state"]) for p in phases]
+    else:
+        rows = [
+            (p["startTimeInSeconds"], p["endTimeInSeconds"], state)
+            for (state, conf) in enumerate(SLEEP_PHASES_CONFIG["garmin"])
+            for p in phases.get(conf["id"], [])
+        ]
+    if not rows:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.int64)
+    starts, ends, states = np.array(rows, dtype=np.int64).T
+    return starts, ends, states
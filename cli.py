@@ -1,3 +1,9 @@
+import json
+import multiprocessing
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+
 import click
 
 from flask import Blueprint, current_app
@@ -23,6 +29,109 @@ def create_user(email, password):
 @click.argument("provider")
 def delete_token(email, provider):
     user = models.User.get(email=email)
-    user.token.pop(provider, None)
+    user.set_token(provider, None)
     print(user.token)
-    user.save()
+
+
+def _push_app_context():
+    """Process pool initializer, workers use the app's database like any command"""
+    from app import app
+    app.app_context().push()
+
+
+def _update_scores(ids):
+    models.Day.refresh_scores(ids)
+    # the sleep score is an insights outcome
+    models.Moments.record(ids)
+    return len(ids)
+
+
+@bp.cli.command("update-scores")
+@click.option("--since", type=click.DateTime(formats=["%Y-%m-%d"]), default=None)
+@click.option("--until", type=click.DateTime(formats=["%Y-%m-%d"]), default=None)
+@click.option("--processes", default=os.cpu_count(), help="Scoring processes")
+@click.option("--chunk-size", default=1000, help="Days scored per batch")
+def update_scores(since, until, processes, chunk_size):
+    """Recompute the materialized day scores of existing history, e.g. after a formula change"""
+    days = models.Day.select(models.Day.id).order_by(models.Day.id)
+    if since:
+        days = days.where(models.Day.date >= since.date())
+    if until:
+        days = days.where(models.Day.date <= until.date())
+    ids = [id for (id,) in days.tuples()]
+    chunks = [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+    # fresh interpreters, not forks sharing this process' connections
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(processes, mp_context=context, initializer=_push_app_context) as executor:
+        done = sum(executor.map(_update_scores, chunks))
+    print(f"Updated scores for {done} days.")
+
+
+@bp.cli.command("rebuild-insights")
+def rebuild_insights():
+    """Recount the journal / sleep moments behind `/api/insights` from existing history"""
+    for user in models.User.select():
+        models.Moments.rebuild([user])
+    print("Insights rebuilt.")
+
+
+@bp.cli.command("sync-credentials")
+def sync_credentials():
+    """Rebuild the credential lookup table from user tokens, migrations fill it on deploy"""
+    for user in models.User.select():
+        for provider in user.token:
+            models.Credential.sync(user, provider)
+    print("Credentials synced.")
+
+
+@bp.cli.command("backfill")
+@click.argument("email")
+@click.option("--provider", type=click.Choice(["withings", "garmin"]), required=True)
+@click.option("--since", type=click.DateTime(formats=["%Y-%m-%d"]), required=True)
+@click.option("--until", type=click.DateTime(formats=["%Y-%m-%d"]), default=None, help="Defaults to today")
+@click.option("--concurrency", default=4, help="Windows fetched in parallel")
+@click.option("--restart", is_flag=True, help="Fetch again the windows done by a previous run")
+def backfill(email, provider, since, until, concurrency, restart):
+    """Fetch a user's history from a provider, resuming a previous run"""
+    import backfill as _backfill
+    user = models.User.get(email=email)
+    done, failed = _backfill.run(
+        user, provider, since.date(), until=until.date() if until else None, concurrency=concurrency, restart=restart,
+    )
+    print(f"{done} window(s) done, {failed} failed (left to the worker).")
+
+
+@bp.cli.command("worker")
+@click.option("--concurrency", type=int, default=None, help="Number of draining threads")
+@click.option("--once", is_flag=True, help="Exit when the queue is empty")
+def worker(concurrency, once):
+    """Process queued webhook payloads"""
+    import metrics
+    import worker as _worker
+    concurrency = concurrency or current_app.config["WORKER_CONCURRENCY"]
+    if port := current_app.config["METRICS_PORT"]:
+        metrics.serve(port)
+    _worker.run(current_app._get_current_object(), concurrency=concurrency, once=once)
+
+
+@bp.cli.command("bench")
+@click.option("--users", default=3, help="Synthetic users")
+@click.option("--years", default=2, help="Years of history per user")
+@click.option("--repeat", default=20, help="Calls per case")
+@click.option("--baseline", type=click.Path(dir_okay=False), help="Defaults to the committed `bench-baseline.json`")
+@click.option("--save", is_flag=True, help="Store results as the new baseline")
+def bench(users, years, repeat, baseline, save):
+    """Benchmark hot paths on synthetic data built from `data/`, use a scratch database"""
+    import bench as _bench
+    results = _bench.run(current_app._get_current_object(), users=users, years=years, repeat=repeat)
+    baseline = baseline or _bench.BASELINE
+    try:
+        with open(baseline) as f:
+            previous = json.load(f)
+    except FileNotFoundError:
+        previous = {}
+    print("\n".join(_bench.compare(results, previous)))
+    if save:
+        with open(baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {baseline}.")
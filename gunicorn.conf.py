@@ -0,0 +1,23 @@
+import os
+import shutil
+import tempfile
+
+# metrics of the worker processes are shared through this directory, cf `metrics.registry`
+# set before any import of prometheus_client, workers import the app after the fork
+multiproc_dir = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "sleep-prometheus")
+)
+
+# same level as the app logger, cf `settings.LOG_LEVEL`
+loglevel = os.environ.get("LOG_LEVEL", "INFO").lower()
+
+
+def on_starting(server):
+    # values of a previous run would be summed with the new ones
+    shutil.rmtree(multiproc_dir, ignore_errors=True)
+    os.makedirs(multiproc_dir)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
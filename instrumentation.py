@@ -0,0 +1,93 @@
+import json
+import time
+
+from contextlib import contextmanager
+
+from flask import before_render_template, current_app, g, has_request_context, request, template_rendered
+
+# Server-Timing metric name -> description
+METRICS = {
+    "db": "SQL",
+    "tpl": "Templates",
+    "json": "JSON serialization",
+}
+
+
+def _timings():
+    if not has_request_context():
+        return None
+    if "timings" not in g:
+        g.timings = {name: 0.0 for name in METRICS}
+        g.queries = 0
+        g.statements = []
+    return g.timings
+
+
+def record_query(sql, duration):
+    """Called by the database for each executed statement, cf `models.InstrumentedDatabase`"""
+    timings = _timings()
+    if timings is None:
+        return
+    timings["db"] += duration
+    g.queries += 1
+    if current_app.config["SLOW_REQUEST_MS"] is not None:
+        g.statements.append((round(duration * 1000, 3), sql))
+
+
+@contextmanager
+def timed(name):
+    """Add the duration of the block to the request's `name` timing"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if (timings := _timings()) is not None:
+            timings[name] += time.perf_counter() - start
+
+
+def on_before_render(sender, template, context, **extra):
+    g.template_start = time.perf_counter()
+
+
+def on_rendered(sender, template, context, **extra):
+    if (timings := _timings()) is not None and "template_start" in g:
+        timings["tpl"] += time.perf_counter() - g.pop("template_start")
+
+
+def before_request():
+    g.request_start = time.perf_counter()
+    _timings()
+
+
+def after_request(response):
+    if "request_start" not in g:
+        return response
+    total = (time.perf_counter() - g.request_start) * 1000
+    timings = {name: round(value * 1000, 3) for (name, value) in _timings().items()}
+    if current_app.config["SERVER_TIMING"]:
+        response.headers["Server-Timing"] = ", ".join(
+            [f'{name};dur={value};desc="{METRICS[name]}"' for (name, value) in timings.items()]
+            + [f'total;dur={round(total, 3)}']
+        )
+    line = {
+        "endpoint": request.endpoint,
+        "method": request.method,
+        "status": response.status_code,
+        "queries": g.queries,
+        "total_ms": round(total, 3),
+        **{f"{name}_ms": value for (name, value) in timings.items()},
+    }
+    current_app.logger.info(f"request_timing {json.dumps(line)}")
+    slow = current_app.config["SLOW_REQUEST_MS"]
+    if slow is not None and total > slow:
+        current_app.logger.warning(
+            f"slow_request {json.dumps({**line, 'url': request.full_path, 'statements': g.statements})}"
+        )
+    return response
+
+
+def init_app(app):
+    app.before_request(before_request)
+    app.after_request(after_request)
+    before_render_template.connect(on_before_render, app)
+    template_rendered.connect(on_rendered, app)
@@ -0,0 +1,55 @@
+from bisect import bisect_left, bisect_right
+
+
+class IntervalIndex:
+    """`(start, end, item)` intervals sorted by start, overlap lookups by bisection
+
+    Lookups only scan the intervals starting within the longest interval's length of the query.
+    """
+
+    def __init__(self, intervals=()):
+        self.starts, self.ends, self.items = [], [], []
+        self.longest = None
+        for (start, end, item) in sorted(intervals, key=lambda i: i[0]):
+            self.add(start, end, item)
+
+    def add(self, start, end, item):
+        idx = bisect_right(self.starts, start)
+        self.starts.insert(idx, start)
+        self.ends.insert(idx, end)
+        self.items.insert(idx, item)
+        if self.longest is None or end - start > self.longest:
+            self.longest = end - start
+
+    def overlapping(self, start, end, gap=None):
+        """Items of the intervals overlapping `[start, end]`, or less than `gap` away from it"""
+        if not self.starts:
+            return []
+        if gap is not None:
+            start, end = start - gap, end + gap
+        lo = bisect_left(self.starts, start - self.longest)
+        hi = bisect_right(self.starts, end)
+        return [self.items[i] for i in range(lo, hi) if self.ends[i] >= start]
+
+
+def canonical(sleeps, priority):
+    """One sleep per group of overlapping sleeps of a day, from the first provider of `priority`
+
+    `sleeps` are `(day, provider, start, end, ...)` tuples, unknown providers come last.
+    """
+    rank = {provider: i for (i, provider) in enumerate(priority)}
+
+    def best(group):
+        return min(group, key=lambda s: rank.get(s[1], len(rank)))
+
+    kept, group, group_end = [], [], None
+    for sleep in sorted(sleeps, key=lambda s: (s[0], s[2])):
+        (day, _, start, end) = sleep[:4]
+        if group and (day != group[0][0] or start >= group_end):
+            kept.append(best(group))
+            group = []
+        group_end = max(group_end, end) if group else end
+        group.append(sleep)
+    if group:
+        kept.append(best(group))
+    return kept
@@ -0,0 +1,99 @@
+import hmac
+import os
+import time
+
+from contextlib import contextmanager
+
+from flask import Blueprint, abort, current_app, g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess,
+    start_http_server,
+)
+
+from models import pool_stats
+
+bp = Blueprint("metrics", __name__)
+
+# webhook elements, `outcome` is one of received, rejected, processed, skipped, failed
+WEBHOOK_PAYLOADS = Counter(
+    "webhook_payloads", "Webhook payload elements by outcome", ["provider", "kind", "outcome"],
+)
+INGEST_DURATION = Histogram(
+    "ingest_duration_seconds", "Duration of an ingest handler call (a batch for garmin)", ["kind"],
+)
+INGEST_LATENCY = Histogram(
+    "ingest_latency_seconds", "Time from webhook reception to storage, per element", ["kind"],
+    buckets=(.1, .5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600, float("inf")),
+)
+WITHINGS_REQUESTS = Histogram(
+    "withings_request_duration_seconds", "Withings API calls", ["action", "status"],
+)
+TOKEN_REFRESHES = Counter(
+    "token_refreshes", "OAuth token updates", ["provider", "outcome"],
+)
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Requests served", ["endpoint", "method", "status"],
+)
+# summed over the live processes of the host
+POOL_CONNECTIONS = Gauge(
+    "db_pool_connections", "Database pool connections", ["state"], multiprocess_mode="livesum",
+)
+
+
+def webhook(provider, kind, outcome, count=1):
+    if count:
+        WEBHOOK_PAYLOADS.labels(provider, kind, outcome).inc(count)
+
+
+@contextmanager
+def withings_call(action):
+    """Time a Withings API call, the block yields a dict to put the `response` in"""
+    call = {"response": None}
+    start = time.perf_counter()
+    try:
+        yield call
+    finally:
+        status = call["response"].status_code if call["response"] is not None else "error"
+        WITHINGS_REQUESTS.labels(action, status).observe(time.perf_counter() - start)
+
+
+def after_request(response):
+    # started by `instrumentation.before_request`
+    if "request_start" in g:
+        REQUEST_DURATION.labels(request.endpoint or "unknown", request.method, response.status_code).observe(
+            time.perf_counter() - g.request_start
+        )
+    stats = pool_stats()
+    for state in ("in_use", "idle"):
+        if state in stats:
+            POOL_CONNECTIONS.labels(state).set(stats[state])
+    return response
+
+
+def registry():
+    """Aggregate the metrics of all the processes when running under gunicorn, cf `gunicorn.conf.py`"""
+    if not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        return REGISTRY
+    collector = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collector)
+    return collector
+
+
+@bp.route("/metrics")
+def metrics():
+    token = current_app.config["METRICS_TOKEN"]
+    if not token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        abort(401)
+    return generate_latest(registry()), 200, {"Content-Type": CONTENT_TYPE_LATEST}
+
+
+def serve(port):
+    """Expose the metrics on a separate port, for processes without a web server (the job worker)"""
+    start_http_server(port, registry=registry())
+
+
+def init_app(app):
+    app.after_request(after_request)
+    app.register_blueprint(bp)
@@ -0,0 +1,165 @@
+# auto-generated snapshot
+from peewee import *
+import datetime
+import peewee
+import playhouse.postgres_ext
+
+import models
+
+
+snapshot = Snapshot()
+
+
+@snapshot.append
+class User(peewee.Model):
+    email = TextField(unique=True)
+    password = TextField()
+    active = BooleanField(default=True)
+    fs_uniquifier = TextField()
+    confirmed_at = DateTimeField(null=True)
+    token = playhouse.postgres_ext.BinaryJSONField(default={}, index=True)
+    class Meta:
+        table_name = "user"
+
+
+@snapshot.append
+class Day(peewee.Model):
+    user = snapshot.ForeignKeyField(backref='days', index=True, model='user')
+    date = DateField(unique=True)
+    notes = TextField(null=True)
+    alcohol_doses = IntegerField(null=True)
+    mood = IntegerField(null=True)
+    tiredness_morning = IntegerField(null=True)
+    tiredness_evening = IntegerField(null=True)
+    nap_minutes = IntegerField(null=True)
+    office = BooleanField(null=True)
+    vacation = BooleanField(null=True)
+    sleep_score_value = IntegerField(null=True)
+    battery_score_value = IntegerField(null=True)
+    class Meta:
+        table_name = "day"
+
+
+@snapshot.append
+class Role(peewee.Model):
+    name = CharField(max_length=255, unique=True)
+    description = TextField(null=True)
+    permissions = TextField(null=True)
+    class Meta:
+        table_name = "role"
+
+
+@snapshot.append
+class Sleep(peewee.Model):
+    day = snapshot.ForeignKeyField(backref='sleeps', index=True, model='day')
+    provider = CharField(max_length=255)
+    duration_total = IntegerField()
+    duration_rem = IntegerField()
+    duration_deep = IntegerField()
+    duration_awake = IntegerField()
+    phases = models.PhasesField(null=True)
+    score = IntegerField(null=True)
+    start = DateTimeField()
+    end = DateTimeField()
+    offset = IntegerField()
+    class Meta:
+        table_name = "sleep"
+        indexes = (
+            (('day', 'provider'), True),
+            )
+
+
+@snapshot.append
+class Stress(peewee.Model):
+    day = snapshot.ForeignKeyField(backref='stresses', index=True, model='day')
+    provider = CharField(max_length=255)
+    duration_total = IntegerField()
+    stress_values = models.TimeseriesField(null=True)
+    battery_values = models.TimeseriesField(null=True)
+    start = DateTimeField()
+    end = DateTimeField()
+    offset = IntegerField()
+    class Meta:
+        table_name = "stress"
+        indexes = (
+            (('day', 'provider'), True),
+            )
+
+
+@snapshot.append
+class Credential(peewee.Model):
+    user = snapshot.ForeignKeyField(backref='credentials', index=True, model='user', on_delete='CASCADE')
+    provider = CharField(max_length=255)
+    external_id = CharField(max_length=255, null=True)
+    access_token = TextField(null=True)
+    refresh_token = TextField(null=True)
+    class Meta:
+        table_name = "credential"
+        indexes = (
+            (('provider', 'user'), True),
+            (('provider', 'external_id'), False),
+            (('provider', 'access_token'), False),
+            (('provider', 'refresh_token'), False),
+            )
+
+
+@snapshot.append
+class Job(peewee.Model):
+    kind = CharField(max_length=255)
+    key = CharField(max_length=255)
+    payload = playhouse.postgres_ext.BinaryJSONField()
+    status = CharField(default='pending', max_length=255)
+    attempts = IntegerField(default=0)
+    run_at = DateTimeField(default=datetime.datetime.utcnow)
+    last_error = TextField(null=True)
+    created_at = DateTimeField(default=datetime.datetime.utcnow)
+    class Meta:
+        table_name = "job"
+        indexes = (
+            (('kind', 'key'), True),
+            (('status', 'run_at'), False),
+            )
+
+
+@snapshot.append
+class UserRoles(peewee.Model):
+    user = snapshot.ForeignKeyField(backref='roles', index=True, model='user')
+    role = snapshot.ForeignKeyField(backref='users', index=True, model='role')
+    class Meta:
+        table_name = "userroles"
+
+
+def _convert(old_model, model, fields, codec):
+    """One UPDATE per row, values go through a python codec"""
+    query = old_model.select(old_model.id, *[getattr(old_model, f) for f in fields]).tuples()
+    return [
+        model.update({
+            getattr(model, f): codec[f](value) for (f, value) in zip(fields, values)
+        }).where(model.id == pk)
+        for (pk, *values) in query
+    ]
+
+
+def forward(old_orm, new_orm):
+    return [
+        # JSONB -> compact bytea, cf `models.encode_phases` / `models.encode_timeseries`
+        *_convert(old_orm['sleep'], new_orm['sleep'], ["phases"], {"phases": models.encode_phases}),
+        *_convert(old_orm['stress'], new_orm['stress'], ["stress_values", "battery_values"], {
+            "stress_values": models.encode_timeseries,
+            "battery_values": models.encode_timeseries,
+        }),
+    ]
+
+
+def backward(old_orm, new_orm):
+    # the bytea fields of the new snapshot already decode the values (NULL as empty ones)
+    def timeseries_json(value):
+        return dict(value.items())
+
+    return [
+        *_convert(new_orm['sleep'], old_orm['sleep'], ["phases"], {"phases": lambda value: value}),
+        *_convert(new_orm['stress'], old_orm['stress'], ["stress_values", "battery_values"], {
+            "stress_values": timeseries_json,
+            "battery_values": timeseries_json,
+        }),
+    ]
@@ -0,0 +1,217 @@
+# auto-generated snapshot
+from peewee import *
+import datetime
+import peewee
+import playhouse.postgres_ext
+
+import models
+
+
+snapshot = Snapshot()
+
+
+@snapshot.append
+class User(peewee.Model):
+    email = TextField(unique=True)
+    password = TextField()
+    active = BooleanField(default=True)
+    fs_uniquifier = TextField()
+    confirmed_at = DateTimeField(null=True)
+    token = playhouse.postgres_ext.BinaryJSONField(default={}, index=True)
+    data_version = IntegerField(default=0)
+    class Meta:
+        table_name = "user"
+
+
+@snapshot.append
+class Day(peewee.Model):
+    user = snapshot.ForeignKeyField(backref='days', index=True, model='user')
+    date = DateField()
+    notes = TextField(null=True)
+    alcohol_doses = IntegerField(null=True)
+    mood = IntegerField(null=True)
+    tiredness_morning = IntegerField(null=True)
+    tiredness_evening = IntegerField(null=True)
+    nap_minutes = IntegerField(null=True)
+    office = BooleanField(null=True)
+    vacation = BooleanField(null=True)
+    sleep_score_value = IntegerField(null=True)
+    battery_score_value = IntegerField(null=True)
+    insight_sample = playhouse.postgres_ext.BinaryJSONField(index=False, null=True)
+    class Meta:
+        table_name = "day"
+        indexes = (
+            (('user', 'date'), True),
+            )
+
+
+@snapshot.append
+class Role(peewee.Model):
+    name = CharField(max_length=255, unique=True)
+    description = TextField(null=True)
+    permissions = TextField(null=True)
+    class Meta:
+        table_name = "role"
+
+
+@snapshot.append
+class Sleep(peewee.Model):
+    day = snapshot.ForeignKeyField(backref='sleeps', index=True, model='day')
+    provider = CharField(max_length=255)
+    duration_total = IntegerField()
+    duration_rem = IntegerField()
+    duration_deep = IntegerField()
+    duration_awake = IntegerField()
+    phases = models.PhasesField(null=True)
+    score = IntegerField(null=True)
+    start = DateTimeField()
+    end = DateTimeField()
+    offset = IntegerField()
+    updated_at = DateTimeField(default=datetime.datetime.utcnow)
+    class Meta:
+        table_name = "sleep"
+        indexes = (
+            (('day', 'provider'), True),
+            )
+
+
+@snapshot.append
+class Stress(peewee.Model):
+    day = snapshot.ForeignKeyField(backref='stresses', index=True, model='day')
+    provider = CharField(max_length=255)
+    duration_total = IntegerField()
+    stress_values = models.TimeseriesField(null=True)
+    battery_values = models.TimeseriesField(null=True)
+    start = DateTimeField()
+    end = DateTimeField()
+    offset = IntegerField()
+    updated_at = DateTimeField(default=datetime.datetime.utcnow)
+    class Meta:
+        table_name = "stress"
+        indexes = (
+            (('day', 'provider'), True),
+            )
+
+
+@snapshot.append
+class Credential(peewee.Model):
+    user = snapshot.ForeignKeyField(backref='credentials', index=True, model='user', on_delete='CASCADE')
+    provider = CharField(max_length=255)
+    external_id = CharField(max_length=255, null=True)
+    access_token = TextField(null=True)
+    refresh_token = TextField(null=True)
+    expires_at = IntegerField(null=True)
+    class Meta:
+        table_name = "credential"
+        indexes = (
+            (('provider', 'user'), True),
+            (('provider', 'external_id'), False),
+            (('provider', 'access_token'), False),
+            (('provider', 'refresh_token'), False),
+            (('provider', 'expires_at'), False),
+            )
+
+
+@snapshot.append
+class Job(peewee.Model):
+    kind = CharField(max_length=255)
+    key = CharField(max_length=255)
+    payload = playhouse.postgres_ext.BinaryJSONField()
+    status = CharField(default='pending', max_length=255)
+    attempts = IntegerField(default=0)
+    run_at = DateTimeField(default=datetime.datetime.utcnow)
+    last_error = TextField(null=True)
+    created_at = DateTimeField(default=datetime.datetime.utcnow)
+    class Meta:
+        table_name = "job"
+        indexes = (
+            (('status', 'run_at'), False),
+            )
+
+
+@snapshot.append
+class Daily(peewee.Model):
+    day = snapshot.ForeignKeyField(backref='dailies', index=True, model='day')
+    provider = CharField(max_length=255)
+    duration_total = IntegerField()
+    steps = IntegerField(null=True)
+    distance = FloatField(null=True)
+    active_kilocalories = IntegerField(null=True)
+    bmr_kilocalories = IntegerField(null=True)
+    resting_heart_rate = IntegerField(null=True)
+    heart_rate_values = models.TimeseriesField(null=True)
+    steps_values = models.TimeseriesField(null=True)
+    start = DateTimeField()
+    offset = IntegerField()
+    updated_at = DateTimeField(default=datetime.datetime.utcnow)
+    class Meta:
+        table_name = "daily"
+        indexes = (
+            (('day', 'provider'), True),
+            )
+
+
+@snapshot.append
+class Moments(peewee.Model):
+    user = snapshot.ForeignKeyField(backref='moments', index=True, model='user', on_delete='CASCADE')
+    factor = CharField(max_length=255)
+    outcome = CharField(max_length=255)
+    n = IntegerField(default=0)
+    mean_x = DoubleField(default=0)
+    mean_y = DoubleField(default=0)
+    m2_x = DoubleField(default=0)
+    m2_y = DoubleField(default=0)
+    c_xy = DoubleField(default=0)
+    class Meta:
+        table_name = "moments"
+        indexes = (
+            (('user', 'factor', 'outcome'), True),
+            )
+
+
+@snapshot.append
+class Rollup(peewee.Model):
+    day = snapshot.ForeignKeyField(backref='rollups', index=True, model='day')
+    metric = CharField(max_length=255)
+    tier = CharField(max_length=255)
+    start = DateTimeField()
+    count = IntegerField()
+    min = FloatField()
+    max = FloatField()
+    mean = FloatField()
+    total = FloatField()
+    class Meta:
+        table_name = "rollup"
+        indexes = (
+            (('day', 'metric', 'tier', 'start'), True),
+            )
+
+
+@snapshot.append
+class UserRoles(peewee.Model):
+    user = snapshot.ForeignKeyField(backref='roles', index=True, model='user')
+    role = snapshot.ForeignKeyField(backref='users', index=True, model='role')
+    class Meta:
+        table_name = "userroles"
+
+
+# (kind, key) is only unique among the active jobs, a partial index the snapshot can't describe
+def forward(old_orm, new_orm):
+    job = new_orm['job']
+    return [
+        job.raw('DROP INDEX IF EXISTS "job_kind_key"'),
+        job.raw(
+            'CREATE UNIQUE INDEX IF NOT EXISTS "job_kind_key_active" ON "job" ("kind", "key") '
+            "WHERE status IN ('pending', 'running')"
+        ),
+    ]
+
+
+def backward(old_orm, new_orm):
+    job = old_orm['job']
+    return [
+        job.raw('DROP INDEX IF EXISTS "job_kind_key_active"'),
+        # keep the latest job per key
+        job.raw('DELETE FROM "job" a USING "job" b WHERE a.kind = b.kind AND a.key = b.key AND a.id < b.id'),
+        job.raw('CREATE UNIQUE INDEX IF NOT EXISTS "job_kind_key" ON "job" ("kind", "key")'),
+    ]
@@ -1,11 +1,34 @@
-from statistics import mean
+import hashlib
+import json
+import random
+import struct
+import sys
+import time
+import zlib
 
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+import numpy as np
 import peewee as pw
 
 from flask import current_app
 from flask_security import UserMixin, RoleMixin, PeeweeUserDatastore, current_user
+from playhouse.db_url import parse as parse_db_url
 from playhouse.flask_utils import FlaskDB
-from playhouse.postgres_ext import BinaryJSONField
+from playhouse.pool import PooledPostgresqlExtDatabase
+from playhouse.postgres_ext import BinaryJSONField, PostgresqlExtDatabase
+
+import instrumentation
+import scoring
+import settings
+
+from intervals import IntervalIndex, canonical
+from stats import bucket_stats
 
 db_wrapper = FlaskDB()
 
@@ -14,6 +37,246 @@ class BaseModel(db_wrapper.Model):
     pass
 
 
+# Compact binary codecs for timeseries and sleep phases
+#
+# timeseries: header `<BccI` (version, offsets typecode, values typecode, count),
+# then delta-encoded offsets and values as packed little-endian arrays.
+# phases: header `<BBIq` (version, provider kind, count, base start), level names
+# (for garmin), then start offsets from base, durations and states arrays.
+
+CODEC_VERSION = 1
+_TS_HEADER = struct.Struct("<BccI")
+_PHASES_HEADER = struct.Struct("<BBIq")
+PHASES_WITHINGS, PHASES_GARMIN = 0, 1
+
+
+def _pack(typecode, values):
+    arr = array(typecode, values)
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def _unpack(typecode, buf, offset, count):
+    arr = array(typecode)
+    end = offset + arr.itemsize * count
+    arr.frombytes(buf[offset:end])
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr, end
+
+
+def _int_typecode(values, signed=True):
+    lo, hi = (min(values), max(values)) if values else (0, 0)
+    for (typecode, bits) in (("b", 8), ("h", 16), ("i", 32)) if signed else (("B", 8), ("H", 16), ("I", 32)):
+        bound = 2 ** (bits - 1) if signed else 2 ** bits
+        if (-bound if signed else 0) <= lo and hi < bound:
+            return typecode
+    return "q"
+
+
+class Timeseries(Mapping):
+    """Read-only `{offset: value}` view over compact arrays, cf `TimeseriesField`"""
+    __slots__ = ("offsets", "_values")
+
+    def __init__(self, offsets=(), values=()):
+        self.offsets = offsets
+        self._values = values
+
+    def __getitem__(self, key):
+        idx = bisect_left(self.offsets, int(key))
+        if idx == len(self.offsets) or self.offsets[idx] != int(key):
+            raise KeyError(key)
+        return self._values[idx]
+
+    def __iter__(self):
+        return map(str, self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def items(self):
+        return zip(map(str, self.offsets), self._values)
+
+    def values(self):
+        return self._values
+
+    def as_dict(self):
+        """Plain dict with `int` keys, cheaper to build, the JSON provider stringifies them"""
+        return dict(zip(self.offsets, self._values))
+
+
+def encode_timeseries(data):
+    if data is None:
+        return None
+    if isinstance(data, Timeseries):
+        offsets, values = list(data.offsets), list(data._values)
+    else:
+        pairs = sorted((int(k), v) for (k, v) in data.items())
+        offsets, values = [p[0] for p in pairs], [p[1] for p in pairs]
+    deltas = [offsets[0]] + [b - a for (a, b) in zip(offsets, offsets[1:])] if offsets else []
+    dcode = _int_typecode(deltas)
+    vcode = _int_typecode(values) if all(isinstance(v, int) for v in values) else "d"
+    return (
+        _TS_HEADER.pack(CODEC_VERSION, dcode.encode(), vcode.encode(), len(offsets))
+        + _pack(dcode, deltas)
+        + _pack(vcode, values)
+    )
+
+
+def decode_timeseries(buf):
+    if buf is None:
+        return Timeseries()
+    buf = bytes(buf)
+    (_, dcode, vcode, count) = _TS_HEADER.unpack_from(buf)
+    deltas, offset = _unpack(dcode.decode(), buf, _TS_HEADER.size, count)
+    values, _ = _unpack(vcode.decode(), buf, offset, count)
+    return Timeseries(array("q", accumulate(deltas)), values)
+
+
+def encode_phases(phases):
+    """Withings: list of `{startdate, enddate, state}`, extra device fields are dropped.
+    Garmin: `{level: [{startTimeInSeconds, endTimeInSeconds}]}`.
+    """
+    if phases is None:
+        return None
+    if isinstance(phases, list):
+        kind, names = PHASES_WITHINGS, []
+        intervals = [(p["startdate"], p["enddate"], p["state"]) for p in phases]
+    else:
+        kind, names = PHASES_GARMIN, list(phases)
+        intervals = [
+            (p["startTimeInSeconds"], p["endTimeInSeconds"], state)
+            for (state, name) in enumerate(names) for p in phases[name]
+        ]
+    intervals.sort()
+    base = intervals[0][0] if intervals else 0
+    header = _PHASES_HEADER.pack(CODEC_VERSION, kind, len(intervals), base)
+    header += bytes([len(names)]) + b"".join(bytes([len(n.encode())]) + n.encode() for n in names)
+    return (
+        header
+        + _pack("i", [i[0] - base for i in intervals])
+        + _pack("i", [i[1] - i[0] for i in intervals])
+        + _pack("B", [i[2] for i in intervals])
+    )
+
+
+def decode_phases(buf):
+    if buf is None:
+        return {}
+    buf = bytes(buf)
+    (_, kind, count, base) = _PHASES_HEADER.unpack_from(buf)
+    offset = _PHASES_HEADER.size
+    names = []
+    for _ in range(buf[offset]):
+        size = buf[offset + 1]
+        names.append(buf[offset + 2:offset + 2 + size].decode())
+        offset += 1 + size
+    offset += 1
+    starts, offset = _unpack("i", buf, offset, count)
+    durations, offset = _unpack("i", buf, offset, count)
+    states, _ = _unpack("B", buf, offset, count)
+    if kind == PHASES_WITHINGS:
+        return [
+            {"startdate": base + s, "enddate": base + s + d, "state": st}
+            for (s, d, st) in zip(starts, durations, states)
+        ]
+    phases = {name: [] for name in names}
+    for (s, d, st) in zip(starts, durations, states):
+        phases[names[st]].append({"startTimeInSeconds": base + s, "endTimeInSeconds": base + s + d})
+    return phases
+
+
+def split_phases(phases, intervals):
+    """Withings phases starting in each `[startdate, enddate)` interval, with a single sort and bisects"""
+    phases = sorted(phases, key=lambda p: p["startdate"])
+    starts = [p["startdate"] for p in phases]
+    return [phases[bisect_left(starts, start):bisect_left(starts, end)] for (start, end) in intervals]
+
+
+def canonical_sleeps(rows):
+    """`(day, total, deep, rem)` of the sleeps kept when providers overlap, cf `SLEEP_PROVIDER_PRIORITY`
+
+    `rows` are `(day, provider, start, end, total, deep, rem)`.
+    """
+    return [(row[0], *row[4:]) for row in canonical(rows, settings.SLEEP_PROVIDER_PRIORITY)]
+
+
+def merge_sleeps(sleep, fragment):
+    """Sleep fields covering both `sleep` and a fragment of the same night not overlapping it (Garmin)"""
+    merged = {
+        **sleep,
+        "start": min(sleep["start"], fragment["start"]),
+        "end": max(sleep["end"], fragment["end"]),
+        **{f: sleep[f] + fragment[f] for f in ("duration_total", "duration_rem", "duration_deep", "duration_awake")},
+    }
+    if sleep.get("phases") is None or fragment.get("phases") is None:
+        merged["phases"] = sleep.get("phases") or fragment.get("phases")
+    else:
+        levels = sleep["phases"].keys() | fragment["phases"].keys()
+        merged["phases"] = {
+            level: sleep["phases"].get(level, []) + fragment["phases"].get(level, []) for level in levels
+        }
+    return merged
+
+
+def moments_add(state, x, y):
+    """Welford update of `(n, mean_x, mean_y, m2_x, m2_y, c_xy)` with the `(x, y)` pair"""
+    (n, mx, my, m2x, m2y, cxy) = state
+    n += 1
+    dx, dy = x - mx, y - my
+    mx += dx / n
+    my += dy / n
+    return (n, mx, my, m2x + dx * (x - mx), m2y + dy * (y - my), cxy + dx * (y - my))
+
+
+def moments_remove(state, x, y):
+    """Inverse of `moments_add`"""
+    (n, mx, my, m2x, m2y, cxy) = state
+    if n <= 1:
+        return (0, 0.0, 0.0, 0.0, 0.0, 0.0)
+    n -= 1
+    mx_, my_ = (mx * (n + 1) - x) / n, (my * (n + 1) - y) / n
+    dx, dy = x - mx_, y - my_
+    # float drift could make the sums of squares slightly negative
+    return (n, mx_, my_, max(m2x - dx * (x - mx), 0.0), max(m2y - dy * (y - my), 0.0), cxy - dx * (y - my))
+
+
+@contextmanager
+def advisory_lock(name, ids):
+    """Transaction holding Postgres advisory locks on `(name, id)` for each of `ids`, across processes"""
+    namespace = zlib.crc32(name.encode()) & 0x7fffffff
+    with db_wrapper.database.atomic():
+        # always in the same order, not to deadlock with another holder of several of them
+        for id in sorted(set(ids)):
+            db_wrapper.database.execute_sql("SELECT pg_advisory_xact_lock(%s, %s)", (namespace, id))
+        yield
+
+
+class TimeseriesField(pw.BlobField):
+    """`{offset: int}` dicts stored as compact `bytea`, read back as `Timeseries`"""
+
+    def db_value(self, value):
+        if value is not None and not isinstance(value, (bytes, memoryview)):
+            value = encode_timeseries(value)
+        return super().db_value(value)
+
+    def python_value(self, value):
+        return decode_timeseries(value)
+
+
+class PhasesField(pw.BlobField):
+    """Sleep phases stored as compact `bytea`, cf `encode_phases`"""
+
+    def db_value(self, value):
+        if value is not None and not isinstance(value, (bytes, memoryview)):
+            value = encode_phases(value)
+        return super().db_value(value)
+
+    def python_value(self, value):
+        return decode_phases(value)
+
+
 class Role(RoleMixin, BaseModel):
     name = pw.CharField(unique=True)
     description = pw.TextField(null=True)
@@ -27,11 +290,105 @@ class User(UserMixin, BaseModel):
     fs_uniquifier = pw.TextField(null=False)
     confirmed_at = pw.DateTimeField(null=True)
     token = BinaryJSONField(default={})
+    # bumped on every data write, keys the read API cache
+    data_version = pw.IntegerField(default=0)
+
+    @classmethod
+    def bump_data_version(cls, ids):
+        ids = list(ids)
+        if ids:
+            cls.update(data_version=cls.data_version + 1).where(cls.id.in_(ids)).execute()
 
     @classmethod
     def fetch_token(cls, name):
         return current_user.token.get(name)
 
+    @classmethod
+    def get_by_credential(cls, provider, value, lookup="external_id"):
+        """Indexed lookup of a user from a provider id or token, cf `Credential`"""
+        user_id = Credential.user_ids(provider, [value], lookup=lookup).get(value)
+        if user_id is None:
+            raise cls.DoesNotExist(f"No {provider} credential for {lookup}={value}")
+        return cls.get_by_id(user_id)
+
+    def set_token(self, provider, token):
+        """Store (or remove, when `token` is None) a provider token and keep `Credential` in sync"""
+        if token is None:
+            self.token.pop(provider, None)
+        else:
+            self.token[provider] = token
+        self.save()
+        Credential.sync(self, provider)
+
+    @contextmanager
+    def token_lock(self, provider):
+        """Transaction holding a Postgres advisory lock on the user's `provider` token, across processes"""
+        with advisory_lock(f"token:{provider}", [self.id]):
+            yield
+
+
+class Credential(BaseModel):
+    """Indexed mirror of `User.token`, for webhooks and token refresh lookups"""
+    user = pw.ForeignKeyField(User, backref="credentials", on_delete="CASCADE")
+    provider = pw.CharField()
+    # withings `userid`, garmin `oauth_token` (aka `userAccessToken`)
+    external_id = pw.CharField(null=True)
+    access_token = pw.TextField(null=True)
+    refresh_token = pw.TextField(null=True)
+    # unix timestamp, OAuth2 tokens only
+    expires_at = pw.IntegerField(null=True)
+
+    class Meta:
+        indexes = (
+            (("provider", "user"), True),
+            (("provider", "external_id"), False),
+            (("provider", "access_token"), False),
+            (("provider", "refresh_token"), False),
+            (("provider", "expires_at"), False),
+        )
+
+    @staticmethod
+    def fields_from_token(token):
+        external_id = token.get("userid") or token.get("oauth_token")
+        return {
+            "external_id": str(external_id) if external_id is not None else None,
+            "access_token": token.get("access_token") or token.get("oauth_token"),
+            "refresh_token": token.get("refresh_token"),
+            "expires_at": int(token["expires_at"]) if token.get("expires_at") else None,
+        }
+
+    @classmethod
+    def sync(cls, user, provider):
+        token = user.token.get(provider)
+        if not token:
+            cls.delete().where(cls.user == user, cls.provider == provider).execute()
+            return
+        fields = cls.fields_from_token(token)
+        cls.insert(user=user, provider=provider, **fields).on_conflict(
+            conflict_target=[cls.provider, cls.user],
+            preserve=[cls.external_id, cls.access_token, cls.refresh_token, cls.expires_at],
+        ).execute()
+
+    @classmethod
+    def expiring(cls, provider, within):
+        """(user id, expires_at) of the `provider` tokens expiring in less than `within` seconds"""
+        deadline = int(time.time()) + within
+        return list(
+            cls.select(cls.user, cls.expires_at)
+            .where(cls.provider == provider, cls.expires_at < deadline)
+            .tuples()
+        )
+
+    @classmethod
+    def user_ids(cls, provider, values, lookup="external_id"):
+        """Map `lookup` field values to user ids, in one indexed query"""
+        values = list(values)
+        if not values:
+            return {}
+        field = getattr(cls, lookup)
+        query = cls.select(field, cls.user).where(cls.provider == provider, field.in_(values))
+        return dict(query.tuples())
+
 
 class UserRoles(BaseModel):
     user = pw.ForeignKeyField(User, related_name='roles')
@@ -45,7 +402,7 @@ class UserRoles(BaseModel):
 
 class Day(BaseModel):
     user = pw.ForeignKeyField(User, backref="days")
-    date = pw.DateField(unique=True)
+    date = pw.DateField()
     notes = pw.TextField(null=True)
     alcohol_doses = pw.IntegerField(null=True)
     mood = pw.IntegerField(null=True)
@@ -54,6 +411,16 @@ class Day(BaseModel):
     nap_minutes = pw.IntegerField(null=True)
     office = pw.BooleanField(null=True)
     vacation = pw.BooleanField(null=True)
+    # materialized from sleeps and stresses, cf `refresh_scores`
+    sleep_score_value = pw.IntegerField(null=True)
+    battery_score_value = pw.IntegerField(null=True)
+    # factors and outcomes last counted in `Moments`, cf `Moments.record`
+    insight_sample = BinaryJSONField(null=True, index=False)
+
+    class Meta:
+        indexes = (
+            (("user", "date"), True),
+        )
 
     @classmethod
     def get_or_create(cls, day, user, autosave=False):
@@ -66,15 +433,66 @@ class Day(BaseModel):
                 day.save()
             return day
 
-    def sleep_score(self):
-        return round(
-            sum([s.computed_score() for s in self.sleeps]) / len(self.sleeps) / 100
+    @classmethod
+    def bulk_get_or_create(cls, keys):
+        """Upsert days for `(user_id, date)` pairs, return them keyed by those pairs"""
+        keys = set(keys)
+        if not keys:
+            return {}
+        rows = [{"user": user_id, "date": date} for (user_id, date) in keys]
+        cls.insert_many(rows).on_conflict_ignore().execute()
+        days = cls.select().where(
+            cls.user.in_({user_id for (user_id, _) in keys}),
+            cls.date.in_({date for (_, date) in keys}),
         )
+        return {(d.user_id, d.date): d for d in days if (d.user_id, d.date) in keys}
+
+    @classmethod
+    def refresh_scores(cls, ids):
+        """Recompute and store the materialized scores of days `ids`, scored in batch by `scoring`"""
+        ids = list(ids)
+        if not ids:
+            return
+        scores = cls.compute_scores(ids)
+        values = pw.ValuesList(
+            [(id, *scores.get(id, (None, None))) for id in ids], columns=("id", "sleep", "battery"), alias="v",
+        )
+        query = cls.update(
+            sleep_score_value=values.c.sleep.cast("int"),
+            battery_score_value=values.c.battery.cast("int"),
+        ).from_(values).where(cls.id == values.c.id).returning(cls.user)
+        User.bump_data_version({row.user_id for row in query.execute()})
+
+    @classmethod
+    def compute_scores(cls, ids):
+        """`{day_id: (sleep score, battery score)}` of days `ids`, without building model instances"""
+        sleeps = Sleep.select(
+            Sleep.day, Sleep.provider, Sleep.start, Sleep.end,
+            Sleep.duration_total, Sleep.duration_deep, Sleep.duration_rem,
+        ).where(Sleep.day.in_(ids))
+        stresses = Stress.select(Stress.day, Stress.battery_values).where(Stress.day.in_(ids))
+        return scoring.score_days(canonical_sleeps(sleeps.tuples()), list(stresses.tuples()))
+
+    def sleep_score(self):
+        if self.sleep_score_value is not None:
+            return self.sleep_score_value
+        return self.compute_sleep_score()
 
     def battery_score(self):
-        return round(
-            mean([s.computed_battery() for s in self.stresses])
+        if self.battery_score_value is not None:
+            return self.battery_score_value
+        return self.compute_battery_score()
+
+    def compute_sleep_score(self):
+        sleeps = canonical_sleeps(
+            (self.id, s.provider, s.start, s.end, s.duration_total, s.duration_deep, s.duration_rem)
+            for s in self.sleeps
         )
+        return scoring.score_days(sleeps, []).get(self.id, (None, None))[0]
+
+    def compute_battery_score(self):
+        stresses = [(self.id, s.battery_values) for s in self.stresses]
+        return scoring.score_days([], stresses).get(self.id, (None, None))[1]
 
 
 class Sleep(BaseModel):
@@ -84,64 +502,570 @@ class Sleep(BaseModel):
     duration_rem = pw.IntegerField()
     duration_deep = pw.IntegerField()
     duration_awake = pw.IntegerField()
-    phases = BinaryJSONField(default={})
+    phases = PhasesField(null=True)
     score = pw.IntegerField(null=True)
     # UTC
     start = pw.DateTimeField()
     end = pw.DateTimeField()
     offset = pw.IntegerField()
+    updated_at = pw.DateTimeField(default=datetime.utcnow)
+
+    class Meta:
+        indexes = (
+            (("day", "provider"), True),
+        )
 
     @classmethod
     def create_or_update(cls, day, provider, data: dict):
-        try:
-            sleep = cls.get(day=day, provider=provider)
-            cls.update(**data).where(cls.id == sleep.id).execute()
-        except cls.DoesNotExist:
-            sleep = cls(day=day, provider=provider, **data)
-            sleep.save()
+        with Moments.lock([day.user_id]):
+            try:
+                sleep = cls.get(day=day, provider=provider)
+                cls.update(**data, updated_at=datetime.utcnow()).where(cls.id == sleep.id).execute()
+            except cls.DoesNotExist:
+                sleep = cls(day=day, provider=provider, **data)
+                sleep.save()
+            Day.refresh_scores([day.id])
+            Moments.record([day.id])
         return sleep
 
+    @classmethod
+    def bulk_create_or_update(cls, provider, rows: list):
+        """Upsert sleeps (one per `row["day"]`) in a single `INSERT ... ON CONFLICT`
+
+        Callers hold the `Moments.lock` of the days' users, since before creating the days.
+        """
+        # a row can't be upserted twice in the same statement, last one wins
+        now = datetime.utcnow()
+        rows = list({row["day"]: {**row, "provider": provider, "updated_at": now} for row in rows}.values())
+        if not rows:
+            return
+        fields = [cls._meta.fields[f] for f in rows[0] if f not in ("day", "provider")]
+        cls.insert_many(rows).on_conflict(
+            conflict_target=[cls.day, cls.provider],
+            preserve=fields,
+        ).execute()
+        Day.refresh_scores(row["day"] for row in rows)
+        Moments.record(row["day"] for row in rows)
+
+    @classmethod
+    def merge_fragments(cls, provider, fragments):
+        """Store sleeps without a calendar date (`(user, fields)` pairs) with the night they belong to
+
+        A fragment near (cf `SLEEP_MERGE_GAP`) a stored night of any provider goes to that night's day, otherwise
+        to the local date it ends on. It's dropped if it overlaps a `provider` sleep, or merged into the day's
+        `provider` sleep. Nights are looked up by bisection in the user's sleeps around the fragments.
+        Returns the number of stored fragments.
+        """
+        gap = timedelta(seconds=settings.SLEEP_MERGE_GAP)
+        fields = [f for f in cls._meta.sorted_fields if f.name not in ("id", "day", "provider", "updated_at")]
+        by_user = {}
+        for (user, fragment) in sorted(fragments, key=lambda f: f[1]["start"]):
+            by_user.setdefault(user, []).append(fragment)
+
+        rows, stored = {}, 0
+        for (user, user_fragments) in by_user.items():
+            # nights of the days around the fragments, days can start up to a day before their date
+            since = min(f["start"] for f in user_fragments).date() - timedelta(days=1)
+            until = max(f["end"] for f in user_fragments).date() + timedelta(days=1)
+            query = (
+                cls.select(Day.date, cls.provider, *fields)
+                .join(Day)
+                .where(Day.user == user.id, Day.date.between(since, until))
+                .dicts()
+            )
+            nights = IntervalIndex((row["start"], row["end"], row) for row in query)
+            # `provider` sleep of each date, merged into
+            current = {row["date"]: row for row in nights.items if row["provider"] == provider}
+            for fragment in user_fragments:
+                (start, end) = (fragment["start"], fragment["end"])
+                if any(row["provider"] == provider for row in nights.overlapping(start, end)):
+                    continue
+                near = nights.overlapping(start, end, gap)
+                if near:
+                    day = near[0]["date"]
+                else:
+                    day = (end + timedelta(seconds=fragment["offset"])).date()
+                sleep = merge_sleeps(current[day], fragment) if day in current else fragment
+                current[day] = {**sleep, "date": day, "provider": provider}
+                nights.add(start, end, current[day])
+                rows[(user, day)] = {f.name: sleep.get(f.name) for f in fields}
+                stored += 1
+
+        days = Day.bulk_get_or_create((user.id, day) for (user, day) in rows)
+        cls.bulk_create_or_update(provider, [
+            {"day": days[(user.id, day)].id, **kwargs} for ((user, day), kwargs) in rows.items()
+        ])
+        return stored
+
     def computed_score(self):
-        """https://github.com/abulte/sleep.france.sh/issues/1"""
-        # TODO: maybe use min base values for ideal instead of mean
-        ideal_duration = 8 * 3600
-        sleep_gain = self.duration_total - ideal_duration
-        ideal_deep = self.duration_total * 10 / 100
-        deep_gain = self.duration_deep - ideal_deep
-        ideal_rem = self.duration_total * 22.5 / 100
-        rem_gain = self.duration_rem - ideal_rem
-        return sleep_gain + deep_gain + rem_gain
+        """Score of the night with the current formula, cf `scoring.SLEEP_FORMULAS`"""
+        return scoring.sleep_scores(self.duration_total, self.duration_deep, self.duration_rem)
 
 
 class Stress(BaseModel):
     day = pw.ForeignKeyField(Day, backref="stresses")
     provider = pw.CharField()
     duration_total = pw.IntegerField()
-    stress_values = BinaryJSONField(default={})
-    battery_values = BinaryJSONField(default={})
+    stress_values = TimeseriesField(null=True)
+    battery_values = TimeseriesField(null=True)
     # UTC
     start = pw.DateTimeField()
     end = pw.DateTimeField()
     offset = pw.IntegerField()
+    updated_at = pw.DateTimeField(default=datetime.utcnow)
+
+    class Meta:
+        indexes = (
+            (("day", "provider"), True),
+        )
 
     @classmethod
     def create_or_update(cls, day, data: dict, provider="garmin"):
         try:
             stress = cls.get(day=day, provider=provider)
-            cls.update(**data).where(cls.id == stress.id).execute()
+            cls.update(**data, updated_at=datetime.utcnow()).where(cls.id == stress.id).execute()
         except cls.DoesNotExist:
             stress = cls(day=day, provider=provider, **data)
             stress.save()
+        Day.refresh_scores([day.id])
         return stress
 
+    @classmethod
+    def bulk_create_or_update(cls, rows: list, provider="garmin"):
+        """Upsert stresses (one per `row["day"]`) in a single `INSERT ... ON CONFLICT`"""
+        now = datetime.utcnow()
+        rows = list({row["day"]: {**row, "provider": provider, "updated_at": now} for row in rows}.values())
+        if not rows:
+            return
+        update = {
+            cls._meta.fields[f]: pw.EXCLUDED[f]
+            for f in ("duration_total", "start", "end", "offset", "updated_at")
+        }
+        # keep existing values when the new summary doesn't carry any
+        for f in ("stress_values", "battery_values"):
+            field = cls._meta.fields[f]
+            update[field] = pw.fn.COALESCE(pw.EXCLUDED[f], field)
+        cls.insert_many([
+            {"stress_values": None, "battery_values": None, **row} for row in rows
+        ]).on_conflict(
+            conflict_target=[cls.day, cls.provider],
+            update=update,
+        ).execute()
+        Day.refresh_scores(row["day"] for row in rows)
+
     def computed_battery(self):
         if not self.battery_values:
             current_app.logger.warning(f"No battery for stress {self.id}, using 50 as default")
-            return 50
-        return mean(self.battery_values.values())
+        return float(scoring.battery_scores([self.battery_values])[0])
+
+
+class Daily(BaseModel):
+    """Garmin daily summary, pushed again along the day with the day so far"""
+    day = pw.ForeignKeyField(Day, backref="dailies")
+    provider = pw.CharField()
+    duration_total = pw.IntegerField()
+    steps = pw.IntegerField(null=True)
+    distance = pw.FloatField(null=True)
+    active_kilocalories = pw.IntegerField(null=True)
+    bmr_kilocalories = pw.IntegerField(null=True)
+    resting_heart_rate = pw.IntegerField(null=True)
+    # offsets are seconds since `start` (local midnight)
+    heart_rate_values = TimeseriesField(null=True)
+    # cumulated steps at the end of each push
+    steps_values = TimeseriesField(null=True)
+    start = pw.DateTimeField()
+    offset = pw.IntegerField()
+    updated_at = pw.DateTimeField(default=datetime.utcnow)
+
+    class Meta:
+        indexes = (
+            (("day", "provider"), True),
+        )
+
+    @classmethod
+    def bulk_create_or_update(cls, rows: list, provider="garmin"):
+        """Upsert dailies (one per `row["day"]`, the longest wins) and refresh their rollups
+
+        A push older than the stored one is ignored, the step counts of the pushes accumulate in `steps_values`.
+        """
+        latest = {}
+        for row in rows:
+            if row["day"] not in latest or row["duration_total"] >= latest[row["day"]]["duration_total"]:
+                latest[row["day"]] = row
+        if not latest:
+            return
+        stored = {
+            day: (duration, steps_values)
+            for (day, duration, steps_values) in cls.select(cls.day, cls.duration_total, cls.steps_values)
+            .where(cls.day.in_(list(latest)), cls.provider == provider)
+            .tuples()
+        }
+        now = datetime.utcnow()
+        rows = []
+        for (day, row) in latest.items():
+            (duration, steps_values) = stored.get(day, (-1, None))
+            if row["duration_total"] < duration:
+                continue
+            steps_values = dict(steps_values.items()) if steps_values else {}
+            if row.get("steps") is not None:
+                steps_values[str(row["duration_total"])] = row["steps"]
+            rows.append({
+                "heart_rate_values": None, **row, "steps_values": steps_values or None,
+                "provider": provider, "updated_at": now,
+            })
+        if not rows:
+            return
+        update = {cls._meta.fields[f]: pw.EXCLUDED[f] for f in rows[0] if f not in ("day", "provider")}
+        # keep the stored samples when a push doesn't carry any
+        update[cls.heart_rate_values] = pw.fn.COALESCE(pw.EXCLUDED.heart_rate_values, cls.heart_rate_values)
+        cls.insert_many(rows).on_conflict(
+            conflict_target=[cls.day, cls.provider],
+            update=update,
+        ).execute()
+        Rollup.refresh(rows)
+        User.bump_data_version(d.user_id for d in Day.select(Day.user).where(Day.id.in_([r["day"] for r in rows])))
+
+
+class Rollup(BaseModel):
+    """Hourly and daily stats of the `Daily` series, what charts over long ranges read"""
+    day = pw.ForeignKeyField(Day, backref="rollups")
+    metric = pw.CharField()
+    tier = pw.CharField()
+    # local time
+    start = pw.DateTimeField()
+    count = pw.IntegerField()
+    min = pw.FloatField()
+    max = pw.FloatField()
+    mean = pw.FloatField()
+    total = pw.FloatField()
+
+    class Meta:
+        indexes = (
+            (("day", "metric", "tier", "start"), True),
+        )
+
+    # tier -> bucket size (seconds)
+    TIERS = {"hour": 3600, "day": 86400}
+    METRICS = ("heart_rate", "steps")
+
+    @classmethod
+    def refresh(cls, dailies):
+        """Recompute the rollups of `Daily` rows (dicts with their `day` id and series)"""
+        dates = dict(Day.select(Day.id, Day.date).where(Day.id.in_([d["day"] for d in dailies])).tuples())
+        rows = []
+        for daily in dailies:
+            midnight = datetime.combine(dates[daily["day"]], datetime.min.time())
+            for metric in cls.METRICS:
+                series = daily.get(f"{metric}_values")
+                if not series:
+                    continue
+                offsets = np.fromiter(map(int, series.keys()), dtype=np.int64, count=len(series))
+                values = np.fromiter(series.values(), dtype=np.float64, count=len(series))
+                order = np.argsort(offsets, kind="stable")
+                (offsets, values) = (offsets[order], values[order])
+                if metric == "steps":
+                    # steps per push, from the cumulated counts
+                    values = np.maximum(np.diff(values, prepend=0), 0)
+                for (tier, size) in cls.TIERS.items():
+                    for (bucket, count, lo, hi, mean, total) in zip(*bucket_stats(offsets, values, size)):
+                        rows.append({
+                            "day": daily["day"], "metric": metric, "tier": tier,
+                            "start": midnight + timedelta(seconds=int(bucket) * size),
+                            "count": int(count), "min": lo, "max": hi, "mean": mean, "total": total,
+                        })
+        for batch in pw.chunked(rows, 1000):
+            cls.insert_many(batch).on_conflict(
+                conflict_target=[cls.day, cls.metric, cls.tier, cls.start],
+                preserve=[cls.count, cls.min, cls.max, cls.mean, cls.total],
+            ).execute()
+
+
+# journal fields correlated with the sleep outcomes, per day
+INSIGHT_FACTORS = (
+    "alcohol_doses", "office", "vacation", "mood", "tiredness_morning", "tiredness_evening", "nap_minutes",
+)
+INSIGHT_OUTCOMES = ("sleep_score", "deep_ratio", "rem_ratio")
+
+
+class Moments(BaseModel):
+    """Running moments of the `(factor, outcome)` pairs of a user's days, updated on each write
+
+    Insights are read from them in constant time, cf `Moments.insight`.
+    """
+    user = pw.ForeignKeyField(User, backref="moments", on_delete="CASCADE")
+    factor = pw.CharField()
+    outcome = pw.CharField()
+    n = pw.IntegerField(default=0)
+    mean_x = pw.DoubleField(default=0)
+    mean_y = pw.DoubleField(default=0)
+    m2_x = pw.DoubleField(default=0)
+    m2_y = pw.DoubleField(default=0)
+    c_xy = pw.DoubleField(default=0)
+
+    class Meta:
+        indexes = (
+            (("user", "factor", "outcome"), True),
+        )
+
+    STATE = ("n", "mean_x", "mean_y", "m2_x", "m2_y", "c_xy")
+
+    @staticmethod
+    def lock(users):
+        """Transaction holding the insights lock of `users`
+
+        Writers of days and sleeps take it before their first write, and so before the row locks
+        `record` waits for, or they deadlock with a concurrent `record`.
+        """
+        return advisory_lock("insights", users)
+
+    @classmethod
+    def samples(cls, day_ids):
+        """Current `{factor or outcome: value}` of each day, with the stored ones"""
+        def ratio(field):
+            return pw.fn.AVG(field.cast("float8") / pw.fn.NULLIF(Sleep.duration_total, 0))
+
+        query = (
+            Day.select(
+                Day.id, Day.user, Day.insight_sample, *[getattr(Day, f) for f in INSIGHT_FACTORS],
+                Day.sleep_score_value.alias("sleep_score"),
+                ratio(Sleep.duration_deep).alias("deep_ratio"),
+                ratio(Sleep.duration_rem).alias("rem_ratio"),
+            )
+            .join(Sleep, pw.JOIN.LEFT_OUTER)
+            .where(Day.id.in_(day_ids))
+            .group_by(Day.id)
+            .dicts()
+        )
+        for row in query:
+            sample = {
+                k: int(v) if isinstance(v, bool) else v
+                for k in INSIGHT_FACTORS + INSIGHT_OUTCOMES
+                if (v := row[k]) is not None
+            }
+            yield (row["id"], row["user"], row["insight_sample"] or {}, sample)
+
+    @classmethod
+    def record(cls, day_ids):
+        """Move the days' contributions from their stored sample to their current values"""
+        day_ids = list(day_ids)
+        if not day_ids:
+            return
+        users = Day.select(Day.user).where(Day.id.in_(day_ids)).distinct()
+        users = [d.user_id for d in users]
+        # re-entrant, usually already held by the caller
+        with cls.lock(users):
+            states = {
+                (m.user_id, m.factor, m.outcome): tuple(getattr(m, f) for f in cls.STATE)
+                for m in cls.select().where(cls.user.in_(users))
+            }
+            changed, days = set(), []
+            for (day_id, user_id, old, new) in cls.samples(day_ids):
+                if old == new:
+                    continue
+                days.append(Day(id=day_id, insight_sample=new))
+                for factor in INSIGHT_FACTORS:
+                    for outcome in INSIGHT_OUTCOMES:
+                        # days count for a pair once both its values are known
+                        before = (old[factor], old[outcome]) if factor in old and outcome in old else None
+                        after = (new[factor], new[outcome]) if factor in new and outcome in new else None
+                        if before == after:
+                            continue
+                        key = (user_id, factor, outcome)
+                        state = states.get(key, (0, 0.0, 0.0, 0.0, 0.0, 0.0))
+                        if before:
+                            state = moments_remove(state, *before)
+                        if after:
+                            state = moments_add(state, *after)
+                        states[key] = state
+                        changed.add(key)
+            if changed:
+                cls.insert_many([
+                    dict(zip(("user", "factor", "outcome") + cls.STATE, key + states[key])) for key in changed
+                ]).on_conflict(
+                    conflict_target=[cls.user, cls.factor, cls.outcome],
+                    preserve=[cls._meta.fields[f] for f in cls.STATE],
+                ).execute()
+                Day.bulk_update(days, fields=[Day.insight_sample], batch_size=500)
+
+    @classmethod
+    def rebuild(cls, users):
+        """Recount all the days of `users`, e.g. for existing history or to get rid of float drift"""
+        users = [u.id for u in users]
+        with cls.lock(users):
+            cls.delete().where(cls.user.in_(users)).execute()
+            Day.update(insight_sample=None).where(Day.user.in_(users)).execute()
+        cls.record(d.id for d in Day.select(Day.id).where(Day.user.in_(users)))
+
+    def insight(self):
+        """Correlation and effect size, yes/no factors also get the outcome means with and without"""
+        data = {"n": self.n, "correlation": None, "slope": None}
+        if self.n < 3 or self.m2_x <= 0 or self.m2_y <= 0:
+            return data
+        # outcome change for a one unit increase of the factor, least squares
+        slope = self.c_xy / self.m2_x
+        data["correlation"] = round(self.c_xy / (self.m2_x * self.m2_y) ** .5, 3)
+        data["slope"] = round(slope, 3)
+        if isinstance(Day._meta.fields[self.factor], pw.BooleanField):
+            # for a 0/1 factor the slope is the difference of the group means, and the residual
+            # variance their pooled variance (Cohen's d)
+            without = self.mean_y - slope * self.mean_x
+            residual = max(self.m2_y - self.c_xy * slope, 0) / self.n
+            data["mean_with"] = round(without + slope, 3)
+            data["mean_without"] = round(without, 3)
+            data["cohen_d"] = round(slope / residual ** .5, 3) if residual > 0 else None
+        return data
+
+
+class Job(BaseModel):
+    """Durable queue of webhook payloads, drained by the `worker` command"""
+    kind = pw.CharField()
+    # idempotency key, unique per kind among the active jobs (garmin `summaryId`, withings notification window)
+    key = pw.CharField()
+    payload = BinaryJSONField(index=False)
+    # pending -> running -> done | failed
+    status = pw.CharField(default="pending")
+    attempts = pw.IntegerField(default=0)
+    # when a pending job is due, when a running job's lease expires, or when a job was done
+    run_at = pw.DateTimeField(default=datetime.utcnow)
+    last_error = pw.TextField(null=True)
+    created_at = pw.DateTimeField(default=datetime.utcnow)
+
+    # a key can be enqueued again once its job is over, e.g. a summary resent by the provider
+    ACTIVE = ("pending", "running")
+
+    class Meta:
+        indexes = (
+            (("status", "run_at"), False),
+        )
+
+    @classmethod
+    def enqueue(cls, kind, payloads, key=None, once=False):
+        """Enqueue payloads, skipping the ones with an active job for their `key(payload)`
+
+        With `once`, skip the keys of any remaining job, done or failed ones included.
+        """
+        rows = []
+        for payload in payloads:
+            _key = key(payload) if key else None
+            if not _key:
+                _key = hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+            rows.append({"kind": kind, "key": str(_key), "payload": payload})
+        if once and rows:
+            keys = cls.select(cls.key).where(cls.kind == kind, cls.key.in_([r["key"] for r in rows]))
+            known = {k for (k,) in keys.tuples()}
+            rows = [r for r in rows if r["key"] not in known]
+        if rows:
+            # no conflict target, the partial unique index can't be inferred without its predicate
+            cls.insert_many(rows).on_conflict_ignore().execute()
+        return len(rows)
+
+    @classmethod
+    def claim(cls, limit=100, lease=300, *filters):
+        """Lock a batch of due jobs (matching `filters`) for this worker, other workers skip them"""
+        now = datetime.utcnow()
+        with db_wrapper.database.atomic():
+            jobs = list(
+                cls.select()
+                .where(cls.status.in_(cls.ACTIVE), cls.run_at <= now, *filters)
+                .order_by(cls.run_at)
+                .limit(limit)
+                .for_update("FOR UPDATE SKIP LOCKED")
+            )
+            if jobs:
+                cls.update(
+                    status="running",
+                    attempts=cls.attempts + 1,
+                    run_at=now + timedelta(seconds=lease),
+                ).where(cls.id.in_([j.id for j in jobs])).execute()
+        for job in jobs:
+            job.attempts += 1
+        return jobs
+
+    @classmethod
+    def complete(cls, jobs):
+        cls.update(status="done", run_at=datetime.utcnow(), last_error=None).where(
+            cls.id.in_([j.id for j in jobs])
+        ).execute()
+
+    @classmethod
+    def purge(cls, retention):
+        """Delete the jobs done more than `retention` seconds ago, with their payload"""
+        before = datetime.utcnow() - timedelta(seconds=retention)
+        return cls.delete().where(cls.status == "done", cls.run_at < before).execute()
+
+    def retry(self, error, max_attempts=5, delay=30):
+        """Reschedule with jittered exponential backoff, or give up after `max_attempts`"""
+        if self.attempts >= max_attempts:
+            status, run_at = "failed", datetime.utcnow()
+        else:
+            backoff = delay * 2 ** (self.attempts - 1)
+            status, run_at = "pending", datetime.utcnow() + timedelta(seconds=backoff * random.uniform(1, 1.5))
+        Job.update(status=status, run_at=run_at, last_error=str(error)).where(Job.id == self.id).execute()
+        return status
+
+
+Job.add_index(Job.index(Job.kind, Job.key, unique=True, where=Job.status.in_(Job.ACTIVE), name="job_kind_key_active"))
+
+
+class InstrumentedDatabase(PostgresqlExtDatabase):
+    """Reports each statement's duration to `instrumentation`"""
+
+    def execute_sql(self, sql, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().execute_sql(sql, *args, **kwargs)
+        finally:
+            instrumentation.record_query(sql, time.perf_counter() - start)
+
+
+class InstrumentedPooledDatabase(PooledPostgresqlExtDatabase, InstrumentedDatabase):
+    """Connection pool that optionally pings idle connections before handing them out"""
+
+    def __init__(self, *args, health_check=True, **kwargs):
+        self.health_check = health_check
+        super().__init__(*args, **kwargs)
+
+    def _is_closed(self, conn):
+        if super()._is_closed(conn):
+            return True
+        if not self.health_check:
+            return False
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+        except Exception:
+            return True
+        return False
+
+    def stats(self):
+        """Pool gauges, for this process"""
+        return {
+            "max": self._max_connections,
+            "in_use": len(self._in_use),
+            "idle": len(self._connections),
+        }
+
+
+def pool_stats():
+    database = db_wrapper.database
+    database = getattr(database, "obj", database)
+    return database.stats() if isinstance(database, InstrumentedPooledDatabase) else {}
 
 
 def init_app(app):
+    if isinstance(app.config.get("DATABASE"), str):
+        params = parse_db_url(app.config["DATABASE"])
+        if app.config.get("DATABASE_POOL"):
+            app.config["DATABASE"] = InstrumentedPooledDatabase(
+                **params,
+                max_connections=app.config["DATABASE_POOL_MAX_CONNECTIONS"],
+                stale_timeout=app.config["DATABASE_POOL_STALE_TIMEOUT"],
+                timeout=app.config["DATABASE_POOL_TIMEOUT"],
+                health_check=app.config["DATABASE_POOL_HEALTH_CHECK"],
+            )
+        else:
+            app.config["DATABASE"] = InstrumentedDatabase(**params)
     db_wrapper.init_app(app)
     app.user_datastore = PeeweeUserDatastore(db_wrapper, User, Role, UserRoles)
     return app
@@ -149,5 +1073,7 @@ def init_app(app):
 
 def init_db():
     db_wrapper.database.connect()
-    db_wrapper.database.create_tables([Day, User, Sleep, Role, UserRoles, Stress])
+    db_wrapper.database.create_tables([
+        Day, User, Sleep, Role, UserRoles, Stress, Credential, Job, Moments, Daily, Rollup,
+    ])
     print("DB inited.")
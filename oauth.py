@@ -1,20 +1,43 @@
-import requests
+import random
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from urllib.parse import urljoin
 
-from contextlib import contextmanager
+import requests
 
 from authlib.common.urls import add_params_to_qs
 from authlib.integrations.base_client import InvalidTokenError
 from authlib.integrations.flask_client import OAuth
+from authlib.oauth2.rfc6749 import OAuth2Token
 from flask import Blueprint, current_app, url_for, redirect, request
 from flask_security import auth_required, current_user
+from requests.adapters import HTTPAdapter
+
+import metrics
+import settings
 
 from api import api_sleep_withings
 from models import User
+from utils import LRUCache, RateLimiter
 
 
 bp = Blueprint("oauth", __name__, url_prefix="")
 oauth = OAuth()
 
+# user id -> (OAuth2 session, lock), cf `withings_session`
+withings_sessions = LRUCache(256)
+_withings_sessions_lock = Lock()
+# keep-alive connections to the Withings API, shared by all the users' sessions
+withings_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.WITHINGS_MAX_CONNECTIONS)
+# bounds in-flight Withings calls per process
+_withings_slots = BoundedSemaphore(settings.WITHINGS_MAX_CONNECTIONS)
+_withings_executor = ThreadPoolExecutor(max_workers=settings.WITHINGS_MAX_CONNECTIONS)
+withings_rate = RateLimiter(settings.WITHINGS_RATE_LIMIT, burst=settings.WITHINGS_MAX_CONNECTIONS)
+# retried with jittered exponential backoff
+WITHINGS_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
 
 def token_update(provider, token, refresh_token=None, access_token=None):
     current_app.logger.debug(f"on_token_update: {provider} {token}")
@@ -22,22 +45,24 @@ def token_update(provider, token, refresh_token=None, access_token=None):
     # FIXME: ugly code duplication
     if refresh_token:
         try:
-            user = User.get(User.token[provider]["refresh_token"] == refresh_token)
+            user = User.get_by_credential(provider, refresh_token, lookup="refresh_token")
         except User.DoesNotExist:
             current_app.logger.error(f"Failed token refresh for {provider}: {refresh_token}")
+            metrics.TOKEN_REFRESHES.labels(provider, "unknown_token").inc()
             raise InvalidTokenError()
     elif access_token:
         try:
-            user = User.get(User.token[provider]["access_token"] == access_token)
+            user = User.get_by_credential(provider, access_token, lookup="access_token")
         except User.DoesNotExist:
             current_app.logger.error(f"Failed token update for {provider}: {access_token}")
+            metrics.TOKEN_REFRESHES.labels(provider, "unknown_token").inc()
             raise InvalidTokenError()
     else:
         return
 
     # update old token
-    user.token[provider] = token
-    user.save()
+    user.set_token(provider, token)
+    metrics.TOKEN_REFRESHES.labels(provider, "updated").inc()
     current_app.logger.debug("Token updated!")
 
 
@@ -96,8 +121,7 @@ def authorize(provider):
     token = getattr(oauth, provider).authorize_access_token(**kwargs)
     current_app.logger.debug(f"Got authorize token: {token}")
     has_previous_token = current_user.token.get("withings")
-    current_user.token[provider] = token
-    current_user.save()
+    current_user.set_token(provider, token)
     if not has_previous_token and provider == "withings":
         subscribe_withings()
     return redirect(url_for("account"))
@@ -111,25 +135,85 @@ def withings_notify():
 
 
 def subscribe_withings():
-    r = oauth.withings.post("notify", data={
-        "action": "subscribe",
-        "callbackurl": url_for("oauth.authorize", provider="withings", action="notify", _external=True),
-        # sleep activity
-        "appli": 44,
-    })
+    with metrics.withings_call("subscribe") as call:
+        r = call["response"] = oauth.withings.post("notify", data={
+            "action": "subscribe",
+            "callbackurl": url_for("oauth.authorize", provider="withings", action="notify", _external=True),
+            # sleep activity
+            "appli": 44,
+        })
     r.raise_for_status()
     current_app.logger.debug(f"Subscribed to withings updates: {r.json()}")
 
 
-@contextmanager
-def session_for_user(user, provider="withings"):
-    """Hack to act on behalf of a user outside of user's navigation context"""
-    _previous_fetch = getattr(oauth, provider)._fetch_token
-    try:
-        getattr(oauth, provider)._fetch_token = lambda: user.token[provider]
-        yield oauth
-    finally:
-        getattr(oauth, provider)._fetch_token = _previous_fetch
+def withings_session(user):
+    """OAuth2 session acting on behalf of `user`, outside of their navigation context
+
+    Sessions are kept per user and share `withings_adapter`. The token is refreshed here if it
+    expires soon, in the calling thread (and app context), so that the session can then be used
+    from other threads.
+    """
+    with _withings_sessions_lock:
+        if not (cached := withings_sessions.get(user.id)):
+            session = oauth.withings._get_oauth_client()
+            session.default_timeout = settings.WITHINGS_TIMEOUT
+            session.mount(oauth.withings.api_base_url, withings_adapter)
+            cached = (session, Lock())
+            withings_sessions.set(user.id, cached)
+    session, lock = cached
+    with lock:
+        # the stored token may have been refreshed by another process
+        token = OAuth2Token.from_dict(user.token["withings"])
+        if token.is_expired(leeway=settings.WITHINGS_TOKEN_REFRESH_AHEAD):
+            token = refresh_withings_token(user, session)
+        session.token = token
+    return session
+
+
+def refresh_withings_token(user, session):
+    """Single-flight refresh of the user's Withings token
+
+    Callers of other processes wait on the advisory lock and reuse the token stored by the first one,
+    threads of this process are serialized by the session's lock in `withings_session`.
+    """
+    with user.token_lock("withings"):
+        token = OAuth2Token.from_dict(User.get_by_id(user.id).token["withings"])
+        if token.is_expired(leeway=settings.WITHINGS_TOKEN_REFRESH_AHEAD):
+            session.token = token
+            # stored by `token_update`
+            token = session.refresh_token(session.metadata["token_endpoint"], refresh_token=token["refresh_token"])
+    user.token["withings"] = dict(token)
+    return token
+
+
+def withings_request(session, url, data, idempotent=True):
+    """POST to the Withings API, retrying idempotent calls on 429/5xx and connection errors"""
+    attempts = settings.WITHINGS_RETRIES + 1 if idempotent else 1
+    for attempt in range(attempts):
+        retry_after = None
+        withings_rate.acquire()
+        with _withings_slots, metrics.withings_call(data.get("action", url)) as call:
+            try:
+                r = call["response"] = session.post(url, data=data)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == attempts - 1:
+                    raise
+            else:
+                if r.status_code not in WITHINGS_RETRY_STATUSES or attempt == attempts - 1:
+                    return r
+                retry_after = r.headers.get("Retry-After")
+        delay = settings.WITHINGS_RETRY_DELAY * 2 ** attempt
+        time.sleep(float(retry_after) if retry_after and retry_after.isdigit() else random.uniform(0, delay))
+
+
+def withings_requests(user, calls):
+    """Run `(path, data)` idempotent calls for `user` concurrently, responses in the same order"""
+    session = withings_session(user)
+    base_url = oauth.withings.api_base_url
+    futures = [
+        _withings_executor.submit(withings_request, session, urljoin(base_url, path), data) for (path, data) in calls
+    ]
+    return [f.result() for f in futures]
 
 
 def init_app(app):
@@ -0,0 +1,92 @@
+from array import array
+
+import numpy as np
+
+import settings
+
+# version -> vectorized formula, cf `sleep_formula` and `battery_formula`
+SLEEP_FORMULAS = {}
+BATTERY_FORMULAS = {}
+
+
+def sleep_formula(version):
+    """Register a `(total, deep, rem) -> scores` formula, durations in seconds are arrays or numbers"""
+    def register(func):
+        SLEEP_FORMULAS[version] = func
+        return func
+    return register
+
+
+def battery_formula(version):
+    """Register a `(values, owners, count) -> scores` formula for `count` stresses
+
+    `values` are the battery values of all the stresses, `owners` the stress index of each value.
+    """
+    def register(func):
+        BATTERY_FORMULAS[version] = func
+        return func
+    return register
+
+
+@sleep_formula(1)
+def sleep_gains(total, deep, rem):
+    """https://github.com/abulte/sleep.france.sh/issues/1"""
+    # TODO: maybe use min base values for ideal instead of mean
+    ideal_duration = 8 * 3600
+    sleep_gain = total - ideal_duration
+    deep_gain = deep - total * 10 / 100
+    rem_gain = rem - total * 22.5 / 100
+    return sleep_gain + deep_gain + rem_gain
+
+
+@battery_formula(1)
+def battery_mean(values, owners, count):
+    """Mean battery value, 50 without any"""
+    sums = np.bincount(owners, weights=values, minlength=count)
+    counts = np.bincount(owners, minlength=count)
+    return np.divide(sums, counts, out=np.full(count, 50.0), where=counts > 0)
+
+
+def sleep_scores(total, deep, rem, version=None):
+    return SLEEP_FORMULAS[version or settings.SLEEP_SCORE_VERSION](total, deep, rem)
+
+
+def battery_scores(series, version=None):
+    """One score per battery values (`Timeseries`, dict or None) of `series`"""
+    values = [s.values() if s else () for s in series]
+    # `Timeseries` values are arrays, converted without a python loop
+    arrays = [
+        np.asarray(v, dtype=np.float64) if isinstance(v, array) else np.fromiter(v, dtype=np.float64)
+        for v in values
+    ]
+    lengths = np.fromiter((len(a) for a in arrays), dtype=np.int64, count=len(arrays))
+    values = np.concatenate(arrays) if arrays else np.empty(0)
+    owners = np.repeat(np.arange(len(arrays)), lengths)
+    return BATTERY_FORMULAS[version or settings.BATTERY_SCORE_VERSION](values, owners, len(series))
+
+
+def day_means(day_ids, scores):
+    """`{day_id: mean of its scores}`"""
+    if not len(day_ids):
+        return {}
+    days, owners = np.unique(day_ids, return_inverse=True)
+    means = np.bincount(owners, weights=scores) / np.bincount(owners)
+    return dict(zip(days.tolist(), means.tolist()))
+
+
+def score_days(sleeps, stresses, version=None, battery_version=None):
+    """Day scores from `(day_id, total, deep, rem)` sleep rows and `(day_id, battery_values)` stress rows
+
+    Returns `{day_id: (sleep score, battery score)}`, scores are None for days without sleep or stress.
+    """
+    sleeps = np.array(sleeps, dtype=np.int64).reshape(-1, 4)
+    sleep = day_means(sleeps[:, 0], sleep_scores(sleeps[:, 1], sleeps[:, 2], sleeps[:, 3], version))
+    (days, series) = zip(*stresses) if stresses else ((), ())
+    battery = day_means(np.array(days, dtype=np.int64), battery_scores(series, battery_version))
+    return {
+        day: (
+            round(sleep[day] / 100) if day in sleep else None,
+            round(battery[day]) if day in battery else None,
+        )
+        for day in sleep.keys() | battery.keys()
+    }
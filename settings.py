@@ -2,7 +2,48 @@ import os
 
 SECRET_KEY = os.environ.get("FLASK_SECRET_KEY")
 DATABASE = os.environ.get("DATABASE_URL")
+# per process connection pool, shared by the threads of a worker
+DATABASE_POOL = os.environ.get("DATABASE_POOL", "true").lower() == "true"
+DATABASE_POOL_MAX_CONNECTIONS = int(os.environ.get("DATABASE_POOL_MAX_CONNECTIONS", 8))
+# seconds before an idle connection is recycled
+DATABASE_POOL_STALE_TIMEOUT = int(os.environ.get("DATABASE_POOL_STALE_TIMEOUT", 300))
+# seconds to wait for a free connection when the pool is exhausted
+DATABASE_POOL_TIMEOUT = int(os.environ.get("DATABASE_POOL_TIMEOUT", 10))
+DATABASE_POOL_HEALTH_CHECK = os.environ.get("DATABASE_POOL_HEALTH_CHECK", "true").lower() == "true"
 SENTRY_DSN = os.environ.get("SENTRY_DSN")
+# level of the app logger (web and worker), INFO for the `request_timing` lines
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", 2))
+JOB_BATCH_SIZE = int(os.environ.get("JOB_BATCH_SIZE", 100))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 5))
+# seconds, doubled on each attempt
+JOB_RETRY_DELAY = int(os.environ.get("JOB_RETRY_DELAY", 30))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 2))
+# seconds done jobs (and their payload) are kept, done backfill windows are fetched again after that
+JOB_RETENTION = int(os.environ.get("JOB_RETENTION", 3 * 24 * 3600))
+
+# per request query count and timings as a `Server-Timing` header
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "true").lower() == "true"
+# log SQL statements of requests slower than this (ms), disabled if unset
+SLOW_REQUEST_MS = int(os.environ["SLOW_REQUEST_MS"]) if os.environ.get("SLOW_REQUEST_MS") else None
+
+# bearer token for `/metrics`, the endpoint is disabled if unset
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+# port of the job worker's metrics server, disabled if unset
+METRICS_PORT = int(os.environ["METRICS_PORT"]) if os.environ.get("METRICS_PORT") else None
+
+# formulas of the materialized day scores, cf `scoring`, run `flask update-scores` after a change
+SLEEP_SCORE_VERSION = int(os.environ.get("SLEEP_SCORE_VERSION", 1))
+BATTERY_SCORE_VERSION = int(os.environ.get("BATTERY_SCORE_VERSION", 1))
+
+# overlapping nights of several providers count once, for the first provider of this list
+SLEEP_PROVIDER_PRIORITY = os.environ.get("SLEEP_PROVIDER_PRIORITY", "withings,garmin").split(",")
+# seconds between a Garmin sleep without calendar date and a night for it to be part of that night
+SLEEP_MERGE_GAP = int(os.environ.get("SLEEP_MERGE_GAP", 3600))
+
+# in-process cache of read API responses, per worker
+API_CACHE_MAX_BYTES = int(os.environ.get("API_CACHE_MAX_BYTES", 32 * 1024 * 1024))
 
 SECURITY_PASSWORD_SALT = os.environ.get("FLASK_SECRET_KEY")
 SECURITY_POST_LOGIN_VIEW = "dashboard"
@@ -12,7 +53,9 @@ GARMIN_CLIENT_SECRET = os.environ.get("GARMIN_CLIENT_SECRET")
 GARMIN_REQUEST_TOKEN_URL = "https://connectapi.garmin.com/oauth-service/oauth/request_token"  # noqa
 GARMIN_AUTHORIZE_URL = "https://connect.garmin.com/oauthConfirm"
 GARMIN_ACCESS_TOKEN_URL = "https://connectapi.garmin.com/oauth-service/oauth/access_token"  # noqa
-GARMIN_API_BASE_URL = "https://apis.garmin.com/wellness-api/rest/"  # noqa
+GARMIN_API_BASE_URL = os.environ.get("GARMIN_API_BASE_URL", "https://apis.garmin.com/wellness-api/rest/")  # noqa
+# calls per second, per process
+GARMIN_RATE_LIMIT = float(os.environ.get("GARMIN_RATE_LIMIT", 1))
 
 WITHINGS_CLIENT_ID = os.environ.get("WITHINGS_CLIENT_ID")
 WITHINGS_CLIENT_SECRET = os.environ.get("WITHINGS_CLIENT_SECRET")
@@ -20,5 +63,18 @@ WITHINGS_AUTHORIZE_URL = "https://account.withings.com/oauth2_user/authorize2"
 WITHINGS_AUTHORIZE_PARAMS = {
     "scope": "user.activity",
 }
-WITHINGS_ACCESS_TOKEN_URL = "https://wbsapi.withings.net/v2/oauth2"  # noqa
-WITHINGS_API_BASE_URL = "https://wbsapi.withings.net/"
+WITHINGS_ACCESS_TOKEN_URL = os.environ.get("WITHINGS_ACCESS_TOKEN_URL", "https://wbsapi.withings.net/v2/oauth2")  # noqa
+WITHINGS_API_BASE_URL = os.environ.get("WITHINGS_API_BASE_URL", "https://wbsapi.withings.net/")
+# per process, concurrent calls and keep-alive connections to the Withings API
+WITHINGS_MAX_CONNECTIONS = int(os.environ.get("WITHINGS_MAX_CONNECTIONS", 4))
+# calls per second, per process (the API allows 120 per minute)
+WITHINGS_RATE_LIMIT = float(os.environ.get("WITHINGS_RATE_LIMIT", 2))
+# seconds
+WITHINGS_TIMEOUT = float(os.environ.get("WITHINGS_TIMEOUT", 10))
+WITHINGS_RETRIES = int(os.environ.get("WITHINGS_RETRIES", 3))
+# seconds, upper bound of the first retry's random delay, doubled on each attempt
+WITHINGS_RETRY_DELAY = float(os.environ.get("WITHINGS_RETRY_DELAY", 0.5))
+# seconds, tokens expiring within this delay are refreshed (in the background by the job worker)
+WITHINGS_TOKEN_REFRESH_AHEAD = int(os.environ.get("WITHINGS_TOKEN_REFRESH_AHEAD", 600))
+# seconds between two lookups of the tokens to refresh by the job worker
+TOKEN_REFRESH_INTERVAL = int(os.environ.get("TOKEN_REFRESH_INTERVAL", 60))
@@ -0,0 +1,21 @@
+import numpy as np
+
+
+def bucket_stats(offsets, values, size):
+    """Stats of `values` per `size` seconds bucket of their (sorted) `offsets`
+
+    Returns `(buckets, counts, mins, maxs, means, totals)` arrays, for the non-empty buckets.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    if not len(offsets):
+        return (np.empty(0, np.int64),) * 2 + (np.empty(0),) * 4
+    buckets = offsets // size
+    firsts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    counts = np.diff(np.r_[firsts, len(values)])
+    totals = np.add.reduceat(values, firsts)
+    return (
+        buckets[firsts], counts,
+        np.minimum.reduceat(values, firsts), np.maximum.reduceat(values, firsts),
+        totals / counts, totals,
+    )
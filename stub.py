@@ -0,0 +1,85 @@
+import json
+
+from datetime import date, timedelta
+from pathlib import Path
+
+from flask import Flask, request
+
+# Local stand-in for the Withings and Garmin APIs, serving the recorded payloads of `data/` shifted to the
+# requested dates, e.g. for `flask backfill`:
+#   flask --app stub run --port 8001
+#   WITHINGS_API_BASE_URL=http://localhost:8001/ WITHINGS_ACCESS_TOKEN_URL=http://localhost:8001/v2/oauth2 \
+#   GARMIN_API_BASE_URL=http://localhost:8001/garmin/ flask backfill ...
+
+DATA_DIR = Path(__file__).parent / "data"
+
+app = Flask(__name__)
+
+
+def fixture(name):
+    return json.loads((DATA_DIR / name).read_text())
+
+
+def withings(body):
+    return {"status": 0, "body": body}
+
+
+def withings_summary(start, end):
+    """One serie per night in start..end, cf `withings-sleep-summary-payload.json`"""
+    serie = fixture("withings-sleep-summary-payload.json")["body"]["series"][0]
+    recorded = date.fromisoformat(serie["date"])
+    series = []
+    for n in range((end - start).days + 1):
+        day = start + timedelta(days=n)
+        shift = int((day - recorded).total_seconds())
+        series.append({
+            **serie,
+            "id": serie["id"] + n,
+            "date": day.isoformat(),
+            "startdate": serie["startdate"] + shift,
+            "enddate": serie["enddate"] + shift,
+        })
+    return withings({"series": series, "more": False, "offset": 0})
+
+
+def withings_details(startdate, enddate):
+    """Recorded phases moved to `startdate`, cf `withings-sleep-details-payload.json`"""
+    details = fixture("withings-sleep-details-payload.json")["body"]["series"]
+    shift = startdate - details[0]["startdate"]
+    phases = [{**p, "startdate": p["startdate"] + shift, "enddate": p["enddate"] + shift} for p in details]
+    return withings({"series": [p for p in phases if p["startdate"] < enddate]})
+
+
+@app.route("/v2/sleep", methods=["POST"])
+def withings_sleep():
+    form = request.form
+    if form["action"] == "getsummary":
+        if "startdateymd" in form:
+            start, end = date.fromisoformat(form["startdateymd"]), date.fromisoformat(form["enddateymd"])
+        else:
+            start = end = date.today() - timedelta(days=1)
+        return withings_summary(start, end)
+    return withings_details(int(form["startdate"]), int(form["enddate"]))
+
+
+@app.route("/v2/oauth2", methods=["POST"])
+def withings_token():
+    return withings({
+        "userid": request.form.get("userid", 1),
+        "access_token": "stub-access-token",
+        "refresh_token": request.form.get("refresh_token", "stub-refresh-token"),
+        "expires_in": 10800,
+        "token_type": "Bearer",
+        "scope": "user.activity",
+    })
+
+
+@app.route("/notify", methods=["POST"])
+def withings_notify():
+    return withings({"profiles": []})
+
+
+@app.route("/garmin/backfill/<summary>")
+def garmin_backfill(summary):
+    """Garmin answers 202 and pushes the summaries to the webhooks later"""
+    return "", 202
@@ -0,0 +1,104 @@
+from datetime import timedelta
+
+from models import db_wrapper
+
+# metric name -> per day SQL expression, `d` is the day and `s` its sleeps aggregated
+METRICS = {
+    "sleep_score": "d.sleep_score_value",
+    "battery_score": "d.battery_score_value",
+    "deep_ratio": "s.deep_ratio",
+    "rem_ratio": "s.rem_ratio",
+    "mood": "d.mood",
+    "tiredness_morning": "d.tiredness_morning",
+    "alcohol_doses": "d.alcohol_doses",
+    "nap_minutes": "d.nap_minutes",
+}
+# moving average windows, in days
+WINDOWS = (7, 30, 90)
+PERCENTILES = (10, 25, 50, 75, 90)
+
+# One row per calendar day of the range, days without data included so that `ROWS` frames and `lag`
+# count days. The range starts early enough to fill the largest window and its week-over-week lag.
+DAILY_SQL = """
+WITH sleeps AS (
+    SELECT sleep.day_id,
+           avg(sleep.duration_deep::float8 / nullif(sleep.duration_total, 0)) AS deep_ratio,
+           avg(sleep.duration_rem::float8 / nullif(sleep.duration_total, 0)) AS rem_ratio
+    FROM sleep JOIN day ON day.id = sleep.day_id
+    WHERE day.user_id = %(user)s AND day.date BETWEEN %(since)s AND %(end)s
+    GROUP BY sleep.day_id
+), daily AS (
+    SELECT cal.date::date AS date, {columns}
+    FROM generate_series(%(since)s::date, %(end)s::date, interval '1 day') AS cal(date)
+    LEFT JOIN day d ON d.user_id = %(user)s AND d.date = cal.date
+    LEFT JOIN sleeps s ON s.day_id = d.id
+)
+"""
+
+
+def rounded(expr):
+    return f"round(({expr})::numeric, 3)::float8"
+
+
+def trends_sql(metrics):
+    """Moving averages and week-over-week deltas of the 7 days average, per day of the range"""
+    columns = ", ".join(f"({METRICS[m]})::float8 AS {m}" for m in metrics)
+    moving = ", ".join(
+        f"avg({m}) OVER (ORDER BY date ROWS {w - 1} PRECEDING) AS {m}_avg_{w}"
+        for m in metrics for w in WINDOWS
+    )
+    outputs = ", ".join(
+        f"{rounded(m)} AS {m}, "
+        + "".join(f"{rounded(f'{m}_avg_{w}')} AS {m}_avg_{w}, " for w in WINDOWS)
+        + f"{rounded(f'{m}_avg_7 - lag({m}_avg_7, 7) OVER (ORDER BY date)')} AS {m}_wow"
+        for m in metrics
+    )
+    return DAILY_SQL.format(columns=columns) + f"""
+    , windowed AS (SELECT date, {", ".join(metrics)}, {moving} FROM daily)
+    , deltas AS (SELECT date, {outputs} FROM windowed)
+    SELECT * FROM deltas WHERE date >= %(start)s ORDER BY date
+    """
+
+
+def percentiles_sql(metrics):
+    fractions = "ARRAY[" + ", ".join(str(p / 100) for p in PERCENTILES) + "]"
+    columns = ", ".join(f"percentile_cont({fractions}) WITHIN GROUP (ORDER BY {m}) AS {m}" for m in metrics)
+    return DAILY_SQL.format(columns=", ".join(f"({METRICS[m]})::float8 AS {m}" for m in metrics)) + f"""
+    SELECT {columns} FROM daily WHERE date >= %(start)s
+    """
+
+
+def trends(user_id, start, end, metrics=tuple(METRICS)):
+    """`metrics` trends of a user over start..end, computed by the database
+
+    Series are columns (one value per day, `None` when missing) of the day value, its moving
+    averages and the week-over-week delta of its 7 days average. Percentiles are over the range.
+    """
+    params = {
+        "user": user_id,
+        "since": start - timedelta(days=max(WINDOWS) + 7),
+        "start": start,
+        "end": end,
+    }
+    database = db_wrapper.database
+    cursor = database.execute_sql(trends_sql(metrics), params)
+    names = [c[0] for c in cursor.description]
+    columns = list(zip(*cursor.fetchall())) or [()] * len(names)
+    series = dict(zip(names, columns))
+
+    row = database.execute_sql(percentiles_sql(metrics), params).fetchone()
+    return {
+        "dates": series["date"],
+        "series": {
+            m: {
+                "value": series[m],
+                **{f"avg_{w}": series[f"{m}_avg_{w}"] for w in WINDOWS},
+                "wow": series[f"{m}_wow"],
+            }
+            for m in metrics
+        },
+        "percentiles": {
+            m: dict(zip((f"p{p}" for p in PERCENTILES), [round(v, 3) for v in values] if values else []))
+            for (m, values) in zip(metrics, row)
+        },
+    }
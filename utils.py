@@ -1,7 +1,13 @@
+import time
 import typing as t
+from collections import OrderedDict
+from collections.abc import Mapping
 from datetime import date
+from threading import Lock
 
-from flask.json import JSONEncoder
+import orjson
+
+from flask.json.provider import JSONProvider
 from werkzeug.routing import BaseConverter, ValidationError
 
 
@@ -17,9 +23,86 @@ class ISODateConverter(BaseConverter):
         return value.isoformat()
 
 
-class ISODateJSONEncoder(JSONEncoder):
-    """Custom JSON encoder for dates"""
-    def default(self, o):
-        if isinstance(o, date):
-            return o.isoformat()
-        return super().default(o)
+class ORJSONProvider(JSONProvider):
+    """orjson based JSON provider, dates are handled natively, `models.Timeseries` as dicts"""
+    option = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS
+
+    @staticmethod
+    def default(o: t.Any) -> t.Any:
+        if hasattr(o, "as_dict"):
+            return o.as_dict()
+        if isinstance(o, Mapping):
+            return dict(o.items())
+        raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+    def dumps(self, obj: t.Any, **kwargs: t.Any) -> str:
+        return orjson.dumps(obj, default=self.default, option=self.option).decode()
+
+    def loads(self, s: t.Union[str, bytes], **kwargs: t.Any) -> t.Any:
+        return orjson.loads(s)
+
+    def response(self, *args: t.Any, **kwargs: t.Any):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=self.option)
+        return self._app.response_class(body, mimetype="application/json")
+
+
+class LRUCache:
+    """Minimal thread-safe LRU mapping
+
+    Bounded by number of entries and, optionally, by the total `size` given to `set`.
+    """
+
+    def __init__(self, maxsize: int = 1024, maxbytes: t.Optional[int] = None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.currbytes = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: t.Hashable, default: t.Any = None) -> t.Any:
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key][0]
+
+    def set(self, key: t.Hashable, value: t.Any, size: int = 0) -> None:
+        with self._lock:
+            if key in self._data:
+                self.currbytes -= self._data.pop(key)[1]
+            self._data[key] = (value, size)
+            self.currbytes += size
+            while len(self._data) > self.maxsize or (
+                self.maxbytes is not None and self.currbytes > self.maxbytes and self._data
+            ):
+                self.currbytes -= self._data.popitem(last=False)[1][1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.currbytes = 0
+
+
+class RateLimiter:
+    """Thread-safe token bucket, `acquire` blocks until a call is allowed"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
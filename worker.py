@@ -0,0 +1,101 @@
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import groupby
+
+from flask import current_app
+
+import backfill
+import metrics
+
+from api import ingest_garmin_dailies, ingest_garmin_sleeps, ingest_garmin_stresses, ingest_withings_sleep
+from models import Credential, Job, User
+from oauth import withings_session
+
+# kind -> (handler, batched), batched handlers take a list of payloads
+HANDLERS = {
+    "garmin-sleep": (ingest_garmin_sleeps, True),
+    "garmin-stress": (ingest_garmin_stresses, True),
+    "garmin-daily": (ingest_garmin_dailies, True),
+    "withings-sleep": (lambda p: ingest_withings_sleep(p["userid"], p["startdate"], p["enddate"]), False),
+    # refreshes the token if it expires soon, cf `oauth.refresh_withings_token`
+    "withings-token": (lambda p: withings_session(User.get_by_id(p["user_id"])), False),
+    # windows left by `flask backfill`
+    "withings-backfill": (backfill.run_window, False),
+    "garmin-backfill": (backfill.run_window, False),
+}
+
+
+def schedule_token_refreshes():
+    """Enqueue a refresh of the Withings tokens expiring soon, once per token"""
+    expiring = Credential.expiring("withings", within=current_app.config["WITHINGS_TOKEN_REFRESH_AHEAD"])
+    Job.enqueue(
+        "withings-token", [{"user_id": user_id, "expires_at": expires_at} for (user_id, expires_at) in expiring],
+        key=lambda p: f"{p['user_id']}:{p['expires_at']}", once=True,
+    )
+
+
+def run_batch(kind, batch):
+    """Run a batch of jobs, a failed batch is run again one job at a time so only the bad payloads are retried"""
+    config = current_app.config
+    handler, batched = HANDLERS[kind]
+    provider, data_type = kind.split("-")
+    try:
+        with metrics.INGEST_DURATION.labels(kind).time():
+            handler([j.payload for j in batch] if batched else batch[0].payload)
+    except Exception as e:
+        if len(batch) == 1:
+            current_app.logger.exception(f"Job {kind} {batch[0].key} failed: {e}")
+            if data_type == "token":
+                metrics.TOKEN_REFRESHES.labels(provider, "failed").inc()
+            elif data_type != "backfill":
+                metrics.webhook(provider, data_type, "failed")
+            batch[0].retry(e, max_attempts=config["JOB_MAX_ATTEMPTS"], delay=config["JOB_RETRY_DELAY"])
+            return
+        current_app.logger.warning(f"Batch of {len(batch)} {kind} jobs failed, running them one by one: {e}")
+    else:
+        Job.complete(batch)
+        now = datetime.utcnow()
+        for job in batch:
+            metrics.INGEST_LATENCY.labels(kind).observe((now - job.created_at).total_seconds())
+        return
+    for job in batch:
+        run_batch(kind, [job])
+
+
+def run_jobs(jobs):
+    """Run claimed jobs, batching the ones whose handler supports it"""
+    jobs = sorted(jobs, key=lambda j: j.kind)
+    for (kind, group) in groupby(jobs, key=lambda j: j.kind):
+        group = list(group)
+        batches = [group] if HANDLERS[kind][1] else [[j] for j in group]
+        for batch in batches:
+            run_batch(kind, batch)
+
+
+def drain(app, once=False):
+    """Claim and run jobs until the queue is empty (`once`) or forever"""
+    with app.app_context():
+        next_refresh = 0
+        while True:
+            if time.monotonic() >= next_refresh:
+                schedule_token_refreshes()
+                Job.purge(app.config["JOB_RETENTION"])
+                next_refresh = time.monotonic() + app.config["TOKEN_REFRESH_INTERVAL"]
+            jobs = Job.claim(limit=app.config["JOB_BATCH_SIZE"])
+            if jobs:
+                run_jobs(jobs)
+            elif once:
+                return
+            else:
+                time.sleep(app.config["JOB_POLL_INTERVAL"])
+
+
+def run(app, concurrency=1, once=False):
+    if concurrency <= 1:
+        return drain(app, once=once)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(drain, app, once) for _ in range(concurrency)]
+        for future in futures:
+            future.result()